@@ -0,0 +1,172 @@
+import os
+import fcntl
+import json
+import mmap
+import struct
+import time
+from array import array
+
+# Append-only on-disk storage for the blocks of a ledger.
+#
+#   segment000000.log, segment000001.log, ...  one JSON block per line, a new segment every segmentSize bytes
+#   index.bin                                  16 bytes per height: segment (uint32), offset (uint64), length (uint32)
+#
+# A block is serialised once when it is appended. Data and index are fsynced in groups, every syncEvery
+# blocks or syncInterval seconds, data first so the index never points at bytes that are not on disk.
+# Opening a store maps the index and reads nothing else, blocks are only read and decoded when asked for.
+# BlockStore behaves like the list the chain used to be: len, [height - 1], [-1], iteration, append.
+# A store is held by one process at a time, a second one opening the same directory gets a RuntimeError.
+
+indexRecord = struct.Struct('<IQI')
+
+
+class BlockStore:
+    def __init__(self, directory, segmentSize=64 * 1024 * 1024, syncEvery=32, syncInterval=1.0):
+        self.directory = directory
+        self.segmentSize = segmentSize
+        self.syncEvery = syncEvery
+        self.syncInterval = syncInterval
+        os.makedirs(directory, exist_ok=True)
+        self.lockFile = open(os.path.join(directory, "lock"), "w")
+        try:
+            fcntl.flock(self.lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.lockFile.close()
+            raise RuntimeError(f"Block store {directory} is already open in another process")
+
+        self.indexPath = os.path.join(directory, "index.bin")
+        self.recover()
+
+        # Heights already on disk come from the mapped index, heights appended since then from tail
+        self.mappedCount = os.path.getsize(self.indexPath) // indexRecord.size
+        self.indexMap = None
+        if self.mappedCount:
+            with open(self.indexPath, "rb") as f:
+                self.indexMap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.tail = array('Q')  # segment, offset, length of every appended block
+
+        self.readFds = {}
+        self.lastBlock = None
+        self.indexFile = open(self.indexPath, "ab")
+        self.segment, self.segmentFile = self.openSegmentForAppend()
+        self.unsynced = 0
+        self.lastSync = time.monotonic()
+
+    def segmentPath(self, segment):
+        return os.path.join(self.directory, f"segment{segment:06d}.log")
+
+    def recover(self):
+        """Cut off what a crash may have left half written: partial index records and unindexed bytes."""
+        if not os.path.exists(self.indexPath):
+            open(self.indexPath, "wb").close()
+        indexSize = os.path.getsize(self.indexPath)
+        count = indexSize // indexRecord.size
+
+        with open(self.indexPath, "r+b") as f:
+            # Drop records whose data did not make it to disk
+            while count:
+                f.seek((count - 1) * indexRecord.size)
+                segment, offset, length = indexRecord.unpack(f.read(indexRecord.size))
+                path = self.segmentPath(segment)
+                if os.path.exists(path) and os.path.getsize(path) >= offset + length:
+                    break
+                count -= 1
+            f.truncate(count * indexRecord.size)
+
+            lastSegment, end = 0, 0
+            if count:
+                f.seek((count - 1) * indexRecord.size)
+                lastSegment, offset, length = indexRecord.unpack(f.read(indexRecord.size))
+                end = offset + length
+
+        # Bytes after the last indexed block, and segments after its segment, were never indexed
+        if os.path.exists(self.segmentPath(lastSegment)):
+            with open(self.segmentPath(lastSegment), "r+b") as f:
+                f.truncate(end)
+        segment = lastSegment + 1
+        while os.path.exists(self.segmentPath(segment)):
+            os.remove(self.segmentPath(segment))
+            segment += 1
+
+    def openSegmentForAppend(self):
+        segment = 0
+        if len(self):
+            segment = self.location(len(self) - 1)[0]
+        return segment, open(self.segmentPath(segment), "ab")
+
+    def __len__(self):
+        return self.mappedCount + len(self.tail) // 3
+
+    def location(self, position):
+        if position < self.mappedCount:
+            return indexRecord.unpack_from(self.indexMap, position * indexRecord.size)
+        k = (position - self.mappedCount) * 3
+        return self.tail[k], self.tail[k + 1], self.tail[k + 2]
+
+    def readBlock(self, position):
+        segment, offset, length = self.location(position)
+        fd = self.readFds.get(segment)
+        if fd is None:
+            fd = self.readFds[segment] = os.open(self.segmentPath(segment), os.O_RDONLY)
+        return json.loads(os.pread(fd, length, offset))
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[k] for k in range(*position.indices(len(self)))]
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError("block height out of range")
+        if position == len(self) - 1:
+            if self.lastBlock is None:
+                self.lastBlock = self.readBlock(position)
+            return self.lastBlock
+        return self.readBlock(position)
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield self[position]
+
+    def __reversed__(self):
+        for position in range(len(self) - 1, -1, -1):
+            yield self[position]
+
+    def append(self, block):
+        data = json.dumps(block, sort_keys=True).encode() + b"\n"
+        offset = self.segmentFile.tell()
+        if offset and offset + len(data) > self.segmentSize:
+            self.sync()
+            self.segmentFile.close()
+            self.segment += 1
+            self.segmentFile = open(self.segmentPath(self.segment), "ab")
+            offset = 0
+
+        self.segmentFile.write(data)
+        self.segmentFile.flush()
+        self.indexFile.write(indexRecord.pack(self.segment, offset, len(data)))
+        self.indexFile.flush()
+        self.tail.extend((self.segment, offset, len(data)))
+        self.lastBlock = block
+
+        self.unsynced += 1
+        if self.unsynced >= self.syncEvery or time.monotonic() - self.lastSync >= self.syncInterval:
+            self.sync()
+
+    def sync(self):
+        if self.unsynced:
+            os.fsync(self.segmentFile.fileno())
+            os.fsync(self.indexFile.fileno())
+            self.unsynced = 0
+        self.lastSync = time.monotonic()
+
+    def close(self):
+        self.sync()
+        self.segmentFile.close()
+        self.indexFile.close()
+        for fd in self.readFds.values():
+            os.close(fd)
+        self.readFds = {}
+        if self.indexMap is not None:
+            self.indexMap.close()
+            self.indexMap = None
+        self.lockFile.close()
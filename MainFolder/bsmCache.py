@@ -0,0 +1,169 @@
+import os
+import json
+import numpy as np
+
+# Columnar cache of the BSM fields used by the trust and ledger scripts.
+# Every column is kept as a .npy file and opened memory-mapped, and a manifest of
+# (filename, mtime, size) makes sure only new or changed bsm*.json files are parsed again.
+
+cacheDirName = ".bsmCache"
+cacheVersion = 2
+
+columnNames = [
+    'filename', 'mtime', 'size',
+    'sender', 'receiver', 'timestamp', 'speed', 'receivedPower',
+    'position', 'receivingPosition', 'messageId', 'messageCount'
+]
+
+
+def isBsmFile(filename):
+    return filename.startswith("bsm") and filename.endswith(".json")
+
+
+def parseBsmFilename(filename):
+    """Return the (sender, receiver) vehicle ids encoded in bsm<sender>_<receiver>[_<n>].json."""
+    parts = filename.replace("bsm", "").replace(".json", "").split("_")
+    return parts[0], parts[1]
+
+
+def parseBsmFiles(folderName, filenames):
+    """Parse the given BSM files once and return their fields as columns."""
+    rows = {name: [] for name in columnNames if name not in ('filename', 'mtime', 'size')}
+    for filename in filenames:
+        with open(os.path.join(folderName, filename), "r") as f:
+            bsmData = json.load(f)
+        sender, receiver = parseBsmFilename(filename)
+        position = bsmData["position"]
+        receivingPosition = bsmData.get("receivingPosition", position)
+        rows['sender'].append(sender)
+        rows['receiver'].append(receiver)
+        rows['timestamp'].append(bsmData["timestamp"].rstrip("Z"))
+        rows['speed'].append(bsmData["speed"])
+        rows['receivedPower'].append(bsmData.get("receivedPower", 0))
+        rows['position'].append((position["latitude"], position["longitude"], position.get("altitude", 0)))
+        rows['receivingPosition'].append((receivingPosition["latitude"], receivingPosition["longitude"], receivingPosition.get("altitude", 0)))
+        rows['messageId'].append(str(bsmData.get("messageId", "")))
+        rows['messageCount'].append(bsmData.get("messageCount", 0))
+
+    return {
+        'sender': np.array(rows['sender'], dtype=np.str_),
+        'receiver': np.array(rows['receiver'], dtype=np.str_),
+        'timestamp': np.array(rows['timestamp'], dtype='datetime64[s]'),
+        'speed': np.array(rows['speed'], dtype=np.float64),
+        'receivedPower': np.array(rows['receivedPower'], dtype=np.float64),
+        'position': np.array(rows['position'], dtype=np.float64).reshape(-1, 3),
+        'receivingPosition': np.array(rows['receivingPosition'], dtype=np.float64).reshape(-1, 3),
+        'messageId': np.array(rows['messageId'], dtype=np.str_),
+        'messageCount': np.array(rows['messageCount'], dtype=np.int64),
+    }
+
+
+class BsmCache:
+    def __init__(self, folderName, cacheDir=None):
+        self.folderName = folderName
+        self.cacheDir = cacheDir or os.path.join(folderName, cacheDirName)
+        self.columns = {}
+
+    def __len__(self):
+        return len(self.columns.get('filename', ()))
+
+    def __getattr__(self, name):
+        columns = self.__dict__.get('columns', {})
+        if name in columns:
+            return columns[name]
+        raise AttributeError(name)
+
+    def readManifest(self):
+        try:
+            with open(os.path.join(self.cacheDir, "manifest.json"), "r") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if manifest.get('version') != cacheVersion:
+            return None
+        return manifest
+
+    def open(self):
+        """Memory-map every column of the cache as it is on disk."""
+        self.columns = {}
+        for name in columnNames:
+            path = os.path.join(self.cacheDir, f"{name}.npy")
+            self.columns[name] = np.load(path, mmap_mode='r')
+        return self
+
+    def refresh(self, trustFolderMtime=False):
+        """Bring the cache in line with the folder, parsing only new or changed files.
+
+        Every file is stat'ed and compared with the cache, a file rewritten in place does not change the
+        folder mtime. trustFolderMtime skips that scan when the folder mtime is unchanged, only safe when
+        files are added or removed but never rewritten.
+        """
+        # The cache directory lives inside the folder, create it first so it does not bump the folder mtime later
+        os.makedirs(self.cacheDir, exist_ok=True)
+        folderMtime = os.stat(self.folderName).st_mtime_ns
+        manifest = self.readManifest()
+        if manifest is not None and trustFolderMtime and manifest['folderMtime'] == folderMtime:
+            return self.open()
+
+        current = {}
+        with os.scandir(self.folderName) as entries:
+            for entry in entries:
+                if isBsmFile(entry.name) and entry.is_file():
+                    stat = entry.stat()
+                    current[entry.name] = (stat.st_mtime_ns, stat.st_size)
+
+        keepRows = []
+        if manifest is not None:
+            self.open()
+            cachedNames = self.columns['filename'].tolist()
+            cachedMtimes = self.columns['mtime'].tolist()
+            cachedSizes = self.columns['size'].tolist()
+            for row, filename in enumerate(cachedNames):
+                if current.get(filename) == (cachedMtimes[row], cachedSizes[row]):
+                    keepRows.append(row)
+                    del current[filename]
+            if not current and len(keepRows) == len(cachedNames):
+                # Nothing changed, only the recorded folder mtime may be stale
+                if manifest['folderMtime'] != folderMtime:
+                    self.writeManifest(folderMtime, len(cachedNames))
+                return self
+
+        changed = sorted(current)
+        parsed = parseBsmFiles(self.folderName, changed)
+        parsed['filename'] = np.array(changed, dtype=np.str_)
+        parsed['mtime'] = np.array([current[name][0] for name in changed], dtype=np.int64)
+        parsed['size'] = np.array([current[name][1] for name in changed], dtype=np.int64)
+
+        if manifest is not None:
+            keepRows = np.array(keepRows, dtype=np.int64)
+            columns = {name: np.concatenate([self.columns[name][keepRows], parsed[name]]) for name in columnNames}
+        else:
+            columns = parsed
+
+        # Release our own mappings before the files underneath are replaced
+        self.columns = {}
+        self.write(columns, folderMtime)
+        return self.open()
+
+    def write(self, columns, folderMtime):
+        for name in columnNames:
+            path = os.path.join(self.cacheDir, f"{name}.npy")
+            tmpPath = path + ".tmp"
+            with open(tmpPath, "wb") as f:
+                np.save(f, columns[name])
+            os.replace(tmpPath, path)
+
+        # Manifest goes last so a half written cache is never picked up as valid
+        self.writeManifest(folderMtime, len(columns['filename']))
+
+    def writeManifest(self, folderMtime, length):
+        manifest = {'version': cacheVersion, 'folderMtime': folderMtime, 'length': length}
+        tmpPath = os.path.join(self.cacheDir, "manifest.json.tmp")
+        with open(tmpPath, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmpPath, os.path.join(self.cacheDir, "manifest.json"))
+
+
+def loadBsmCache(folderName, trustFolderMtime=False):
+    """Open the columnar cache for folderName, building or updating it when needed."""
+    return BsmCache(folderName).refresh(trustFolderMtime)
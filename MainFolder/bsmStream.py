@@ -0,0 +1,210 @@
+import os
+import json
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+import numpy as np
+from bsmCache import isBsmFile, parseBsmFilename
+
+# Streaming ingestion of a BSM folder that the RSU keeps writing into.
+# Each stage is a generator, stages run on their own threads and are joined by bounded queues,
+# so a slow ledger blocks the stages in front of it instead of letting memory grow.
+#
+#   watch (scandir cursor) -> parse -> score -> submit -> caller (trust rounds)
+#
+# Writers should create BSM files atomically (write to a temp name, then rename). A file that
+# cannot be parsed yet is handed back to the cursor and picked up again once it changes or its
+# retry delay has passed, the delay doubling each time. After maxAttempts it is quarantined.
+
+endOfStream = object()
+
+
+class ScandirCursor:
+    """Remembers which BSM files were already handed out and finds the new ones with os.scandir."""
+
+    def __init__(self, folderName, maxAttempts=8, retryDelay=0.05):
+        self.folderName = folderName
+        self.maxAttempts = maxAttempts
+        self.retryDelay = retryDelay
+        self.seen = set()
+        self.failed = {}  # filename -> (mtime in ns, failed attempts, retry not before) of files waiting for a retry
+        self.quarantined = set()  # Files that never parsed, left in the folder but not handed out again
+        self.lock = threading.Lock()
+
+    def poll(self):
+        """Return (mtime in seconds, filename) of the BSM files that appeared since the last poll, oldest first."""
+        # Always scanned, the folder mtime is too coarse to tell whether a file arrived since the last poll
+        with self.lock:
+            newFiles = []
+            with os.scandir(self.folderName) as entries:
+                now = time.monotonic()
+                for entry in entries:
+                    if isBsmFile(entry.name) and entry.name not in self.seen:
+                        mtime = entry.stat().st_mtime_ns
+                        failed = self.failed.get(entry.name)
+                        if failed is not None and failed[0] == mtime and now < failed[2]:
+                            continue  # Unchanged since it last failed to parse, wait out its delay
+                        newFiles.append((mtime, entry.name))
+            newFiles.sort()
+            self.seen.update(name for _, name in newFiles)
+            return [(mtime / 1e9, name) for mtime, name in newFiles]
+
+    def retry(self, filename):
+        """Hand filename out again once it changes or after its retry delay, quarantine it after maxAttempts."""
+        try:
+            mtime = os.stat(os.path.join(self.folderName, filename)).st_mtime_ns
+        except OSError:
+            mtime = None  # Gone, a file written again under the same name is picked up as a new one
+        with self.lock:
+            attempts = self.failed.pop(filename, (None, 0, 0))[1] + 1
+            if mtime is not None and attempts >= self.maxAttempts:
+                self.quarantined.add(filename)
+                print(f"Quarantined {filename}: not a parseable BSM after {attempts} attempts")
+                return
+            self.seen.discard(filename)
+            if mtime is not None:
+                self.failed[filename] = (mtime, attempts, time.monotonic() + self.retryDelay * 2 ** (attempts - 1))
+
+    def parsed(self, filename):
+        """filename parsed after earlier failures, its retry state can go."""
+        with self.lock:
+            self.failed.pop(filename, None)
+
+
+class LatencyStats:
+    """Latency samples in seconds from a file landing in the folder to its transaction being pooled."""
+
+    def __init__(self, maxSamples=10000):
+        self.samples = deque(maxlen=maxSamples)
+        self.count = 0
+        self.lock = threading.Lock()  # Samples also arrive from the ledger client's callbacks
+
+    def add(self, latency):
+        with self.lock:
+            self.samples.append(latency)
+            self.count += 1
+
+    def summary(self):
+        with self.lock:
+            count = self.count
+            samples = np.fromiter(self.samples, dtype=np.float64)
+        if not len(samples):
+            return {'count': count}
+        return {
+            'count': count,
+            'p50Ms': float(np.percentile(samples, 50) * 1000),
+            'p99Ms': float(np.percentile(samples, 99) * 1000),
+            'maxMs': float(samples.max() * 1000),
+        }
+
+
+def watchFolder(cursor, stopEvent, pollInterval=0.01):
+    """Yield (filename, landedAt) for every new BSM file until stopEvent is set."""
+    while not stopEvent.is_set():
+        newFiles = cursor.poll()
+        for landedAt, filename in newFiles:
+            yield filename, landedAt
+        if not newFiles:
+            stopEvent.wait(pollInterval)
+
+
+def parseBsms(items, cursor):
+    for filename, landedAt in items:
+        try:
+            with open(os.path.join(cursor.folderName, filename), "r") as f:
+                bsmData = json.load(f)
+        except (OSError, ValueError):
+            # Still being written, or gone again
+            cursor.retry(filename)
+            continue
+        if filename in cursor.failed:
+            cursor.parsed(filename)
+        yield filename, bsmData, landedAt
+
+
+def scoreBsms(items, scoreBsm):
+    for filename, bsmData, landedAt in items:
+        try:
+            bsmTrust = float(scoreBsm(bsmData["speed"], bsmData.get("receivedPower", 0),
+                                      bsmData["position"]["latitude"], bsmData["position"]["longitude"]))
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            # Valid JSON but not a BSM, skipped so one bad file does not end the stream
+            print(f"Skipped {filename}: not a scoreable BSM ({e!r})")
+            continue
+        yield filename, bsmData, bsmTrust, landedAt
+
+
+def recordPooled(latencyStats, landedAt):
+    def done(future):
+        if future.exception() is None and future.result().get('status') == 201:
+            latencyStats.add(time.time() - landedAt)
+    return done
+
+
+def submitBsms(items, submitBsm, latencyStats):
+    for filename, bsmData, bsmTrust, landedAt in items:
+        sender_id, receiver_id = parseBsmFilename(filename)
+        pooled = submitBsm(sender_id, receiver_id, bsmData)
+        if isinstance(pooled, Future):
+            # Queued by a batching client, the latency is only known once the ledger answers the batch
+            pooled.add_done_callback(recordPooled(latencyStats, landedAt))
+        else:
+            latencyStats.add(time.time() - landedAt)
+        yield sender_id, receiver_id, bsmData, bsmTrust
+
+
+def drainQueue(inQueue):
+    while True:
+        item = inQueue.get()
+        if item is endOfStream:
+            return
+        yield item
+
+
+def runStage(items, outQueue, errors):
+    """Pump a stage generator into outQueue on its own thread, put blocks while the queue is full."""
+    def pump():
+        try:
+            for item in items:
+                outQueue.put(item)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            outQueue.put(endOfStream)
+
+    thread = threading.Thread(target=pump, daemon=True)
+    thread.start()
+    return thread
+
+
+def streamBsms(folderName, scoreBsm, submitBsm, stopEvent=None, latencyStats=None, pollInterval=0.01, queueSize=256):
+    """Watch folderName and yield (sender_id, receiver_id, bsmData, bsmTrust) once each new BSM is pooled.
+
+    scoreBsm(speed, receivedPower, latitude, longitude) returns the bsmTrust of a message and
+    submitBsm(sender_id, receiver_id, bsmData) hands it to the ledger, returning nothing once it is pooled or a
+    Future of the ledger's per-transaction result if it is only queued. The stream ends when
+    stopEvent is set, latencyStats collects the file mtime to pooling latency.
+    """
+    stopEvent = stopEvent or threading.Event()
+    latencyStats = latencyStats if latencyStats is not None else LatencyStats()
+    cursor = ScandirCursor(folderName)
+    errors = []
+
+    parseQueue = queue.Queue(maxsize=queueSize)
+    scoreQueue = queue.Queue(maxsize=queueSize)
+    submitQueue = queue.Queue(maxsize=queueSize)
+    pooledQueue = queue.Queue(maxsize=queueSize)
+
+    runStage(watchFolder(cursor, stopEvent, pollInterval), parseQueue, errors)
+    runStage(parseBsms(drainQueue(parseQueue), cursor), scoreQueue, errors)
+    runStage(scoreBsms(drainQueue(scoreQueue), scoreBsm), submitQueue, errors)
+    runStage(submitBsms(drainQueue(submitQueue), submitBsm, latencyStats), pooledQueue, errors)
+
+    try:
+        yield from drainQueue(pooledQueue)
+    finally:
+        stopEvent.set()
+    if errors:
+        raise errors[0]
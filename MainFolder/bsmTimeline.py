@@ -0,0 +1,35 @@
+import os
+import json
+import numpy as np
+from bsmCache import loadBsmCache
+
+# Time-ordered pass over a BSM folder, built on the columnar cache.
+#
+# The timestamps, filenames and scoring fields come from the cache columns, so the order is one lexsort
+# and the scores one batch call, without parsing anything the cache already holds. Raw files are only
+# opened for the payload, one at a time in timestamp order, as the ledger wants it serialised.
+
+
+def iterBsmsByTime(folderName, scoreBsm, filenames=None):
+    """Yield (timestamp, filename, bsmTrust, v2xMessage) for every BSM in folderName, oldest first.
+
+    timestamp is a datetime64[s], bsmTrust comes from scoreBsm(speed, receivedPower, latitude, longitude)
+    run over arrays and v2xMessage is the json.dumps of the BSM. Ties are broken by filename.
+    filenames restricts the pass to those files.
+    """
+    bsmCache = loadBsmCache(folderName)
+    rows = np.arange(len(bsmCache))
+    if filenames is not None:
+        rows = rows[np.isin(bsmCache.filename, np.array(list(filenames), dtype=np.str_))]
+
+    cachedNames = bsmCache.filename[rows]
+    timestamps = bsmCache.timestamp[rows]
+    order = np.lexsort((cachedNames, timestamps))
+    bsmTrust = scoreBsm(bsmCache.speed[rows], bsmCache.receivedPower[rows],
+                        bsmCache.position[rows, 0], bsmCache.position[rows, 1])
+
+    for k in order.tolist():
+        filename = str(cachedNames[k])
+        with open(os.path.join(folderName, filename), "r") as f:
+            v2xMessage = json.dumps(json.load(f))
+        yield timestamps[k], filename, float(bsmTrust[k]), v2xMessage
@@ -0,0 +1,97 @@
+import threading
+from array import array
+
+# In-memory secondary indexes over the sealed blocks of a chain.
+#
+# A transaction is addressed by its chain position, packed as blockIndex << 32 | transactionIndex (both
+# 1-based), and every posting list holds positions in chain order. The indexes are never written to disk:
+# they catch up with the chain before each query, so after a restart the first query rebuilds them from
+# the block store and later ones only index the blocks sealed in between.
+
+positionShift = 32
+positionMask = (1 << positionShift) - 1
+
+
+def packPosition(blockIndex, transactionIndex):
+    return blockIndex << positionShift | transactionIndex
+
+
+def unpackPosition(position):
+    return position >> positionShift, position & positionMask
+
+
+class ChainIndex:
+    def __init__(self, bucketSeconds=60):
+        self.bucketSeconds = bucketSeconds
+        self.byTransactionId = {}
+        self.bySender = {}
+        self.byReceiver = {}
+        self.byTimeBucket = {}  # bucket -> block indexes sealed in it
+        self.blockTimes = array('d')  # seal time of every indexed block, by height - 1
+        self.blockSizes = array('I')  # transaction count of every indexed block, by height - 1
+        self.firstTime = None
+        self.lastTime = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.blockTimes)
+
+    def catchUp(self, wholeChain):
+        """Index every block sealed since the last call."""
+        with self.lock:
+            for height in range(len(self.blockTimes) + 1, len(wholeChain) + 1):
+                self.addBlock(wholeChain[height - 1])
+
+    def addBlock(self, block):
+        blockIndex = block['index']
+        for transactionIndex, transaction in enumerate(block['transactions'], start=1):
+            position = packPosition(blockIndex, transactionIndex)
+            transactionId = transaction.get('transactionId')
+            if transactionId is not None:
+                self.byTransactionId[transactionId] = position
+            self.bySender.setdefault(transaction['senderVehicle'], array('Q')).append(position)
+            self.byReceiver.setdefault(transaction['receiverVehicle'], array('Q')).append(position)
+        bucket = int(block['timestamp'] // self.bucketSeconds)
+        self.byTimeBucket.setdefault(bucket, array('Q')).append(blockIndex)
+        self.blockTimes.append(block['timestamp'])
+        self.blockSizes.append(len(block['transactions']))
+        # Extremes rather than first and last block, the clock may have been set back in between
+        self.firstTime = block['timestamp'] if self.firstTime is None else min(self.firstTime, block['timestamp'])
+        self.lastTime = block['timestamp'] if self.lastTime is None else max(self.lastTime, block['timestamp'])
+
+    def positionsInTime(self, since=None, until=None):
+        """Positions of the transactions in blocks sealed in [since, until]."""
+        if not self.blockTimes:
+            return []
+        since = self.firstTime if since is None else max(since, self.firstTime)
+        until = self.lastTime if until is None else min(until, self.lastTime)
+        blockIndexes = []
+        for bucket in range(int(since // self.bucketSeconds), int(until // self.bucketSeconds) + 1):
+            for blockIndex in self.byTimeBucket.get(bucket, ()):
+                if since <= self.blockTimes[blockIndex - 1] <= until:
+                    blockIndexes.append(blockIndex)
+        blockIndexes.sort()
+        return [packPosition(blockIndex, transactionIndex)
+                for blockIndex in blockIndexes
+                for transactionIndex in range(1, self.blockSizes[blockIndex - 1] + 1)]
+
+    def query(self, transactionId=None, senderVehicle=None, receiverVehicle=None, since=None, until=None):
+        """Positions matching every given filter, in chain order."""
+        with self.lock:
+            candidates = []
+            if transactionId is not None:
+                position = self.byTransactionId.get(transactionId)
+                candidates.append([] if position is None else [position])
+            if senderVehicle is not None:
+                candidates.append(self.bySender.get(senderVehicle, ()))
+            if receiverVehicle is not None:
+                candidates.append(self.byReceiver.get(receiverVehicle, ()))
+            if since is not None or until is not None:
+                candidates.append(self.positionsInTime(since, until))
+            if not candidates:
+                return []
+
+            # Walk the shortest list and probe the others
+            candidates.sort(key=len)
+            others = [set(other) for other in candidates[1:]]
+            return [position for position in candidates[0] if all(position in other for other in others)]
@@ -0,0 +1,67 @@
+import json
+
+# Height ranges and streamed JSON for the /chain route of the ledger servers, and for other long block range listings.
+#
+#   /chain?from=<height>&to=<height>&limit=<blocks>&headers=1
+#
+# Heights are 1-based and inclusive, headers=1 leaves out the transactions (their count is kept).
+# The response is produced a few blocks at a time, so a full dump never sits in memory as a whole.
+
+chunkSize = 64 * 1024  # Bytes of JSON collected before a chunk is sent
+
+
+def parseChainQuery(args, chainLength):
+    """Return (start, end, headersOnly) from the query string, raising ValueError on bad input."""
+    start = int(args.get('from', 1))
+    end = int(args.get('to', chainLength))
+    limit = args.get('limit', None)
+    if start < 1:
+        raise ValueError('from must be at least 1')
+    end = min(end, chainLength)
+    if limit is not None:
+        limit = int(limit)
+        if limit < 1:
+            raise ValueError('limit must be at least 1')
+        end = min(end, start + limit - 1)
+    headersOnly = args.get('headers', '0').lower() in ('1', 'true', 'yes')
+    return start, end, headersOnly
+
+
+def blockHeader(block):
+    header = {key: value for key, value in block.items() if key != 'transactions'}
+    header['transactionCount'] = len(block['transactions'])
+    return header
+
+
+def streamChain(wholeChain, start, end, headersOnly=False, lengthKey='chainLength', extra=None):
+    """Yield the JSON of {'chain': [...blocks start..end], lengthKey, 'from', 'to', 'next', **extra} in chunks.
+
+    The chain length is taken when the stream starts, blocks sealed later show up through 'next'.
+    """
+    chainLength = len(wholeChain)
+    blocks = (wholeChain[height - 1] for height in range(start, end + 1))
+    tail = {lengthKey: chainLength, 'from': start, 'to': max(end, start - 1), 'next': end + 1 if end < chainLength else None}
+    tail.update(extra or {})
+    return streamJsonList('chain', (blockHeader(block) if headersOnly else block for block in blocks), tail)
+
+
+def streamJsonList(listKey, items, tail):
+    """Yield the JSON of {listKey: [...items], **tail} in chunks of about chunkSize bytes.
+
+    tail is only read once every item has been sent, so it may be filled in while the list is produced.
+    """
+    buffered = ['{' + json.dumps(listKey) + ': [']
+    size = 0
+    separator = ''
+    for item in items:
+        text = json.dumps(item, sort_keys=True)
+        buffered.append(separator + text)
+        separator = ','
+        size += len(text)
+        if size >= chunkSize:
+            yield ''.join(buffered)
+            buffered = []
+            size = 0
+
+    buffered.append('], ' + json.dumps(tail, sort_keys=True)[1:] if tail else ']}')
+    yield ''.join(buffered)
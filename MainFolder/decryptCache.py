@@ -0,0 +1,59 @@
+import threading
+from collections import OrderedDict
+
+# Bounded LRU cache of decrypted transaction payloads, keyed by their 1-based (blockIndex, transactionIndex).
+#
+# Sealed blocks never change, so entries are only ever evicted, never invalidated. The bound is on the total
+# length of the cached plaintexts rather than on their number, BSMs vary a lot in size.
+
+
+class DecryptCache:
+    def __init__(self, maxBytes=32 * 1024 * 1024):
+        self.maxBytes = maxBytes
+        self.entries = OrderedDict()  # (blockIndex, transactionIndex) -> plaintext, least recently used first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Cached plaintext for key, or None."""
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if len(value) > self.maxBytes:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self.entries[key] = value
+            self.size += len(value)
+            while self.size > self.maxBytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'maxBytes': self.maxBytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hitRate': self.hits / lookups if lookups else 0.0
+            }
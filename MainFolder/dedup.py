@@ -0,0 +1,96 @@
+import hashlib
+import math
+from time import time
+
+# Replay detection for V2X messages.
+#
+# A message is identified by (senderVehicle, SHA-256 of its plaintext). Keys of pooled transactions sit in a
+# set, keys of sealed transactions go into a time-windowed Bloom filter: one filter per slice of the window,
+# and when a new slice starts the oldest filter is wiped and reused. Memory stays fixed whatever the traffic,
+# the price is a small false positive rate (errorRate per slice at full capacity) and forgetting replays older
+# than the window.
+
+
+def messageKey(senderVehicle, v2xMessage):
+    return hashlib.sha256(senderVehicle.encode() + b'\x00' + hashlib.sha256(v2xMessage.encode()).digest()).digest()
+
+
+class BloomFilter:
+    def __init__(self, capacity, errorRate):
+        self.numBits = max(8, int(math.ceil(-capacity * math.log(errorRate) / math.log(2) ** 2)))
+        self.numHashes = max(1, int(round(self.numBits / capacity * math.log(2))))
+        self.bits = bytearray((self.numBits + 7) // 8)
+
+    def positions(self, key):
+        # Double hashing over two 64 bit halves of the (already uniform) key
+        h1 = int.from_bytes(key[:8], 'little')
+        h2 = int.from_bytes(key[8:16], 'little') | 1
+        return [(h1 + i * h2) % self.numBits for i in range(self.numHashes)]
+
+    def add(self, key):
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+
+    def clear(self):
+        self.bits[:] = bytes(len(self.bits))
+
+
+class TimeWindowedBloomFilter:
+    def __init__(self, windowSeconds=600, numSlices=10, capacityPerSlice=100000, errorRate=1e-4):
+        self.sliceSeconds = windowSeconds / numSlices
+        self.filters = [BloomFilter(capacityPerSlice, errorRate) for _ in range(numSlices)]
+        self.sliceIds = [None] * numSlices
+
+    def sliceOf(self, at):
+        sliceId = int(at // self.sliceSeconds)
+        slot = sliceId % len(self.filters)
+        if self.sliceIds[slot] != sliceId:
+            if self.sliceIds[slot] is not None and self.sliceIds[slot] > sliceId:
+                return None  # Older than the window
+            self.filters[slot].clear()
+            self.sliceIds[slot] = sliceId
+        return self.filters[slot]
+
+    def add(self, key, at=None):
+        bloomFilter = self.sliceOf(time() if at is None else at)
+        if bloomFilter is not None:
+            bloomFilter.add(key)
+
+    def __contains__(self, key):
+        newest = max((sliceId for sliceId in self.sliceIds if sliceId is not None), default=None)
+        if newest is None:
+            return False
+        return any(sliceId is not None and newest - sliceId < len(self.filters) and key in bloomFilter
+                   for sliceId, bloomFilter in zip(self.sliceIds, self.filters))
+
+
+class DuplicateFilter:
+    def __init__(self, windowSeconds=600, numSlices=10, capacityPerSlice=100000, errorRate=1e-4):
+        self.windowSeconds = windowSeconds
+        self.pooled = set()
+        self.recent = TimeWindowedBloomFilter(windowSeconds, numSlices, capacityPerSlice, errorRate)
+
+    def isDuplicate(self, key):
+        return key in self.pooled or key in self.recent
+
+    def addPooled(self, key):
+        self.pooled.add(key)
+
+    def releasePooled(self, key):
+        """The transaction behind key will never be sealed, it may be submitted again."""
+        self.pooled.discard(key)
+
+    def addSealed(self, key, at):
+        """Key of a transaction sealed at time at, used to refill the window from stored blocks after a restart."""
+        self.recent.add(key, at)
+
+    def seal(self, at=None, keys=None):
+        """The keys of a sealed block move from the pool to the recent history, every pooled key if keys is None."""
+        if keys is None:
+            keys, self.pooled = self.pooled, set()
+        for key in keys:
+            self.pooled.discard(key)
+            self.recent.add(key, at)
@@ -1,81 +1,310 @@
+import os
+import atexit
 import hashlib
-import random
 import json
+import itertools
+import threading
 from time import time
 from datetime import datetime
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 from layer1Encryption import Encryption
-from RSU_dist_store import reputation_scores
+from merkle import MerkleTreeCache, buildMerkleTree, merkleRootOf, merkleProof
+from chainView import parseChainQuery, streamChain, streamJsonList
+from blockStore import BlockStore
+from chainIndex import ChainIndex, unpackPosition
+from dedup import DuplicateFilter, messageKey
+from encryptionStage import EncryptionStage
+from decryptCache import DecryptCache
+from validatorRegistry import ValidatorRegistry
+from RSU_dist_store import reputation_store, vehicle_registry
+
+# Persistence is opt-in and set per process, so an HTTP server and an embedded run never share a chain by accident:
+#   DPOS_STORAGE_DIR     directory of the block log, unset keeps the chain in memory only
+#   DPOS_ENCRYPTION_KEY  file holding the AES key of the payloads, required with DPOS_STORAGE_DIR and meant to
+#                        live outside it (e.g. a secrets mount), it is created with mode 0600 on first start
+storageDir = os.environ.get("DPOS_STORAGE_DIR")
+encryptionKeyPath = os.environ.get("DPOS_ENCRYPTION_KEY")
+validatorSeed = None  # Seed of the validator selection RNG, set it to replay a run
+validatorSelection = "fenwick"  # "alias" draws from an alias table snapshot, rebuilt after the weights change
+encryptionWorkers = 2  # Threads encrypting accepted transactions before they join the pool
+decryptCacheBytes = 32 * 1024 * 1024  # Decrypted payloads kept for repeated audits, by total plaintext length
+decryptRangeInlineBlocks = 16  # Longer /transactions/decrypt/range responses are streamed
+
+def loadEncryptionKey(keyPath):
+    """Key of the ledger's layer 1 encryption, read from keyPath or created there on first start."""
+    if os.path.exists(keyPath):
+        with open(keyPath, "rb") as f:
+            return f.read()
+    key = os.urandom(16)
+    os.makedirs(os.path.dirname(os.path.abspath(keyPath)), mode=0o700, exist_ok=True)
+    fd = os.open(keyPath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(key)
+        f.flush()
+        os.fsync(f.fileno())
+    return key
+
+transactionCounter = itertools.count(1)  # Tells apart the transactions of a pair staged within one clock tick
 
 def getTrasactionId(sender, receiver):
     timeNow = time()
-    transactionID = f"{sender[8::]}.{timeNow}.{receiver[8::]}"
+    transactionID = f"{sender[8::]}.{timeNow}.{next(transactionCounter)}.{receiver[8::]}"
     return transactionID
 
+transactionFields = ['senderVehicle', 'receiverVehicle', 'v2xMessage']
+
+def transactionError(transaction):
+    """Why a submitted transaction cannot be staged, None if it can."""
+    if not isinstance(transaction, dict) or not all(field in transaction for field in transactionFields):
+        return "Missing fields in transaction"
+    if not all(isinstance(transaction[field], str) for field in transactionFields):
+        return "senderVehicle, receiverVehicle and v2xMessage must be strings"
+    return None
+
 class Blockchain:
-    def __init__(self):
-        self.wholeChain = []
+    def __init__(self, storageDir=None, validatorSeed=None, validatorSelection="fenwick", encryptionWorkers=2,
+                 decryptCacheBytes=32 * 1024 * 1024, encryptionKeyPath=None):
+        if storageDir is None:
+            self.wholeChain = []
+            self.encryption = Encryption()
+        else:
+            if encryptionKeyPath is None:
+                raise ValueError("A persistent chain needs encryptionKeyPath, the key is not kept with the blocks")
+            # Blocks are appended to disk as they are sealed and read back lazily after a restart
+            self.wholeChain = BlockStore(storageDir)
+            self.encryption = Encryption(loadEncryptionKey(encryptionKeyPath))
+            atexit.register(self.wholeChain.close)
         self.currentTransactions = []
-        self.encryption = Encryption()
-        self.validators = {}
-        self.addBlock(validatorId='genesisValidator', previousHash='0000')
+        self.currentKeys = []  # Replay keys of the pooled transactions, sealed with them
+        self.poolLock = threading.Lock()
+        # Requests are acknowledged once a transaction is staged, it joins the pool after the workers encrypt it
+        self.staging = EncryptionStage(self.encryption, self.poolEncrypted, encryptionWorkers, onDropped=self.releaseKeys)
+        self.validators = ValidatorRegistry(validatorSeed)
+        self.validatorSelection = validatorSelection
+        self.merkleTrees = MerkleTreeCache()  # Trees of recent blocks for inclusion proofs, older ones are rebuilt
+        self.chainIndex = ChainIndex()  # Built from the chain on the first lookup, then kept up to date
+        self.duplicates = DuplicateFilter()  # Replays of (sender, plaintext) in the pool or the last 10 minutes of blocks
+        self.decrypted = DecryptCache(decryptCacheBytes)  # (blockIndex, transactionIndex) -> plaintext of sealed transactions
+        if not self.wholeChain:
+            self.addBlock(validatorId='genesisValidator', previousHash='0000')
+        else:
+            self.loadRecentDuplicates()
+
+    def loadRecentDuplicates(self):
+        """Put the transactions of stored blocks sealed within the replay window back into the duplicate filter."""
+        since = time() - self.duplicates.windowSeconds
+        recentBlocks = []
+        for block in reversed(self.wholeChain):
+            if block['timestamp'] < since:
+                break
+            recentBlocks.append(block)
+        # Oldest first, the filter drops slices older than the newest one it has seen
+        for block in reversed(recentBlocks):
+            plaintexts = self.encryption.decrypt_many([transaction['v2xMessage'] for transaction in block['transactions']])
+            for transaction, plaintext in zip(block['transactions'], plaintexts):
+                self.duplicates.addSealed(messageKey(transaction['senderVehicle'], plaintext), block['timestamp'])
 
     def decryptMessage(self, encryptedMessage):
         decryptedMessage = self.encryption.decrypt(encryptedMessage.encode('utf-8'))
         return decryptedMessage
+
+    def decryptTransactions(self, block, transactionIndexes):
+        """Plaintexts of the given 1-based transactions of a sealed block, cache misses decrypted in one batch."""
+        plaintexts = [self.decrypted.get((block['index'], transactionIndex)) for transactionIndex in transactionIndexes]
+        missing = [k for k, plaintext in enumerate(plaintexts) if plaintext is None]
+        if missing:
+            encryptedMessages = [block['transactions'][transactionIndexes[k] - 1]['v2xMessage'] for k in missing]
+            for k, plaintext in zip(missing, self.encryption.decrypt_many(encryptedMessages)):
+                plaintexts[k] = plaintext
+                self.decrypted.put((block['index'], transactionIndexes[k]), plaintext)
+        return plaintexts
+
+    def iterDecryptedRange(self, start, end, senderVehicle=None, receiverVehicle=None):
+        """Yield the decrypted transactions of blocks start..end, optionally only those of one sender or receiver."""
+        for height in range(start, end + 1):
+            block = self.wholeChain[height - 1]
+            transactionIndexes = [transactionIndex for transactionIndex, transaction in enumerate(block['transactions'], start=1)
+                                  if (senderVehicle is None or transaction['senderVehicle'] == senderVehicle)
+                                  and (receiverVehicle is None or transaction['receiverVehicle'] == receiverVehicle)]
+            for transactionIndex, plaintext in zip(transactionIndexes, self.decryptTransactions(block, transactionIndexes)):
+                transaction = block['transactions'][transactionIndex - 1]
+                yield {
+                    'blockIndex': height,
+                    'transactionIndex': transactionIndex,
+                    'transactionId': transaction.get('transactionId'),
+                    'senderVehicle': transaction['senderVehicle'],
+                    'receiverVehicle': transaction['receiverVehicle'],
+                    'decryptedMessage': plaintext
+                }
+
+    def poolEncrypted(self, transactions, keys):
+        """Called by the encryption stage with encrypted transactions, in the order they were staged."""
+        with self.poolLock:
+            self.currentTransactions.extend(transactions)
+            self.currentKeys.extend(keys)
+
+    def releaseKeys(self, keys):
+        """Replay keys of transactions that will never be pooled, they may be submitted again."""
+        for key in keys:
+            self.duplicates.releasePooled(key)
     
     def addValidator(self, validatorId, opinionValue):
         """Add a validator with an initial opinion value."""
         self.validators[validatorId] = opinionValue
 
     def selectValidator(self):
-        """Select a validator based on their opinion values."""
-        totalOpinion = sum(self.validators.values())
-        if totalOpinion == 0:
+        """Select a validator based on their opinion values, O(log n) through the registry's Fenwick tree."""
+        if self.validators.totalWeight() <= 0:
             raise ValueError("No validators with positive opinion available.")
-
-        randomChoice = random.uniform(0, totalOpinion)
-        cumulative = 0
-        for validator, opinion in self.validators.items():
-            cumulative += opinion
-            if cumulative > randomChoice:
-                return validator
-        return None
+        if self.validatorSelection == "alias" and self.validators.aliasTable is None:
+            self.validators.snapshot()
+        return self.validators.select()
 
     def addBlock(self, validatorId, previousHash=None):
-        """Add a block to the blockchain."""
+        """Seal the pooled transactions into a block, its hash is computed once here and stored in the block."""
+        # Only encrypted transactions ever reach the pool, entries still in the encryption stage wait for the next block
+        with self.poolLock:
+            transactions, keys = self.currentTransactions, self.currentKeys
+            self.currentTransactions, self.currentKeys = [], []
         curBlock = {
             'index': len(self.wholeChain) + 1,
             'timestamp': time(),
-            'transactions': self.currentTransactions,
+            'transactions': transactions,
             'validator': validatorId,
-            'previousHash': previousHash or self.getHash(self.wholeChain[-1])
+            'previousHash': previousHash or self.wholeChain[-1]['hash']
         }
-        self.currentTransactions = []
+        merkleTree = buildMerkleTree(transactions)
+        curBlock['transactionsDigest'] = merkleRootOf(merkleTree)
+        curBlock['hash'] = self.getHash(curBlock)
+        self.merkleTrees.put(curBlock['index'], merkleTree)
+        self.duplicates.seal(curBlock['timestamp'], keys)
         self.wholeChain.append(curBlock)
         return curBlock
 
+    def getTransactionsDigest(self, transactions):
+        """Merkle root of the transactions, in block order."""
+        return merkleRootOf(buildMerkleTree(transactions))
+
+    def findTransaction(self, transactionId):
+        """Return the 1-based (blockIndex, transactionIndex) of a sealed transaction, or None."""
+        self.chainIndex.catchUp(self.wholeChain)
+        positions = self.chainIndex.query(transactionId=transactionId)
+        return unpackPosition(positions[0]) if positions else None
+
+    def queryTransactions(self, offset=0, limit=100, **filters):
+        """Sealed transactions matching every filter of ChainIndex.query, in chain order, one page at a time."""
+        self.chainIndex.catchUp(self.wholeChain)
+        positions = self.chainIndex.query(**filters)
+        blocks = {}
+        page = []
+        for position in positions[offset:offset + limit]:
+            blockIndex, transactionIndex = unpackPosition(position)
+            if blockIndex not in blocks:
+                blocks[blockIndex] = self.wholeChain[blockIndex - 1]
+            page.append({
+                'blockIndex': blockIndex,
+                'transactionIndex': transactionIndex,
+                'transaction': blocks[blockIndex]['transactions'][transactionIndex - 1]
+            })
+        nextOffset = offset + limit if offset + limit < len(positions) else None
+        return {'transactions': page, 'total': len(positions), 'offset': offset, 'next': nextOffset}
+
+    def getInclusionProof(self, blockIndex, transactionIndex):
+        """Transaction, Merkle sibling path and header fields needed to check it against the chain."""
+        block = self.wholeChain[blockIndex - 1]
+        merkleTree = self.merkleTrees.treeOf(block)
+        return {
+            'blockIndex': blockIndex,
+            'transactionIndex': transactionIndex,
+            'transaction': block['transactions'][transactionIndex - 1],
+            'proof': merkleProof(merkleTree, transactionIndex - 1),
+            'merkleRoot': block['transactionsDigest'],
+            'blockHash': block['hash']
+        }
+
     def getHash(self, block):
-        """Generate the SHA-256 hash of a block."""
-        blockString = json.dumps(block, sort_keys=True)
-        return hashlib.sha256(blockString.encode()).hexdigest()
+        """Generate the SHA-256 hash of a block header, the transactions only enter through their digest."""
+        header = [block['index'], block['timestamp'], block['validator'], block['previousHash'], block['transactionsDigest']]
+        return hashlib.sha256(json.dumps(header).encode()).hexdigest()
+
+    def isChainValid(self, checkTransactions=False):
+        """Check every stored hash and link, and with checkTransactions also every transactions digest."""
+        previousHash = '0000'
+        for block in self.wholeChain:
+            if block['previousHash'] != previousHash or block['hash'] != self.getHash(block):
+                return False
+            if checkTransactions and block['transactionsDigest'] != self.getTransactionsDigest(block['transactions']):
+                return False
+            previousHash = block['hash']
+        return True
 
     def newMessage(self, senderVehicle, receiverVehicle, v2xMessage):
-        """Add a new transaction to the current transactions list."""
-        encryptedV2xMessage = self.encryption.encrypt(v2xMessage).decode('utf-8')
+        """Stage a new transaction for encryption, returning the block it is expected in and its staging id."""
+        error = transactionError({'senderVehicle': senderVehicle, 'receiverVehicle': receiverVehicle, 'v2xMessage': v2xMessage})
+        if error is not None:
+            raise ValueError(error)
+        key = messageKey(senderVehicle, v2xMessage)
+        if self.duplicates.isDuplicate(key):
+            raise ValueError("Duplicate transaction detected.")
+        self.duplicates.addPooled(key)
         newMessageTransaction = {
             'senderVehicle': senderVehicle,
             'receiverVehicle': receiverVehicle,
             'transactionId': getTrasactionId(senderVehicle, receiverVehicle),
-            'v2xMessage': encryptedV2xMessage,
+            'v2xMessage': v2xMessage,  # Replaced by its ciphertext before the transaction is pooled
             'validationStatus': 'trusted',
             'RSU_ID': 'rsu1'
         }
-        self.currentTransactions.append(newMessageTransaction)
-        return self.wholeChain[-1]['index'] + 1
+        try:
+            stagedId, = self.staging.submit([newMessageTransaction], [key])
+        except Exception:
+            self.releaseKeys([key])
+            raise
+        return self.wholeChain[-1]['index'] + 1, stagedId
+
+    def newMessages(self, transactions):
+        """Validate and stage a group of transactions for encryption, returning one result per item."""
+        blockIndex = self.wholeChain[-1]['index'] + 1
+        results = []
+        newTransactions = []
+        keys = []
+        for transaction in transactions:
+            error = transactionError(transaction)
+            if error is not None:
+                results.append({'status': 400, 'error': error})
+                continue
+            # Added to the pool keys right away so duplicates inside the batch are caught too
+            key = messageKey(transaction['senderVehicle'], transaction['v2xMessage'])
+            if self.duplicates.isDuplicate(key):
+                results.append({'status': 400, 'error': 'Duplicate transaction detected.'})
+                continue
+            self.duplicates.addPooled(key)
+            keys.append(key)
+            newTransactions.append({
+                'senderVehicle': transaction['senderVehicle'],
+                'receiverVehicle': transaction['receiverVehicle'],
+                'transactionId': getTrasactionId(transaction['senderVehicle'], transaction['receiverVehicle']),
+                'v2xMessage': transaction['v2xMessage'],
+                'validationStatus': 'trusted',
+                'RSU_ID': 'rsu1'
+            })
+            results.append({'status': 201, 'block': blockIndex, 'transactionId': newTransactions[-1]['transactionId']})
+
+        # Staged together so the workers encrypt the accepted messages in as few passes as possible
+        try:
+            stagedIds = iter(self.staging.submit(newTransactions, keys))
+        except Exception:
+            self.releaseKeys(keys)
+            raise
+        for result in results:
+            if result['status'] == 201:
+                result['stagedId'] = next(stagedIds)
+        return results
 
     def verifyAndAddBlock(self):
         """Select a validator and attempt to forge a block."""
+        # Everything acknowledged before this call goes into the block
+        self.staging.drain()
         try:
             selectedValidator = self.selectValidator()
             newBlock = self.addBlock(selectedValidator)
@@ -84,20 +313,61 @@ class Blockchain:
             return None, str(e)
 
 
+def summariseBatch(results):
+    accepted = sum(1 for result in results if result['status'] == 201)
+    return {'accepted': accepted, 'rejected': len(results) - accepted, 'results': results}
+
+
+def addInitialValidators(blockchain):
+    """Seed the validators with the current reputation of every registered vehicle."""
+    opinions = reputation_store.latest()
+    for i, vehicleId in enumerate(vehicle_registry.vehicleIds):
+        blockchain.addValidator(f"vehicle_{vehicleId}", opinions[i])
+
+
 # Initialize Flask app
 app = Flask(__name__)
-blockchain = Blockchain()
+blockchain = Blockchain(storageDir, validatorSeed, validatorSelection, encryptionWorkers, decryptCacheBytes, encryptionKeyPath)
 
 @app.route('/transactions/new', methods=['POST'])
 def newTransaction():
     data = request.get_json()
-    required_fields = ['senderVehicle', 'receiverVehicle', 'v2xMessage']
+    error = transactionError(data)
+    if error is not None:
+        return error, 400
 
-    if not all(field in data for field in required_fields):
-        return "Missing fields in transaction", 400
+    try:
+        index, stagedId = blockchain.newMessage(data['senderVehicle'], data['receiverVehicle'], data['v2xMessage'])
+    except ValueError as e:
+        return str(e), 400
+    return jsonify({'message': f'New transaction added to block {index}', 'stagedId': stagedId}), 201
 
-    index = blockchain.newMessage(data['senderVehicle'], data['receiverVehicle'], data['v2xMessage'])
-    return jsonify({'message': f'New transaction added to block {index}'}), 201
+@app.route('/transactions/batch', methods=['POST'])
+def newTransactionBatch():
+    data = request.get_json()
+    transactions = data.get('transactions', None) if isinstance(data, dict) else data
+
+    if not isinstance(transactions, list):
+        return "Expected a list of transactions", 400
+
+    return jsonify(summariseBatch(blockchain.newMessages(transactions))), 200
+
+@app.route('/transactions/staged', methods=['GET'])
+def stagedTransactions():
+    # A staged transaction is in the pool once its stagedId is at most pooledThrough and it is not in failed
+    stagedId = request.args.get('stagedId', type=int)
+    if stagedId is not None:
+        status = blockchain.staging.status(stagedId)
+        if status is None:
+            return 'Unknown stagedId', 404
+        return jsonify({'stagedId': stagedId, 'status': status}), 200
+    failedCount, failed = blockchain.staging.failures()
+    return jsonify({
+        'pending': blockchain.staging.pending(),
+        'pooledThrough': blockchain.staging.pooledThrough,
+        'failedCount': failedCount,
+        'failed': failed
+    }), 200
 
 @app.route('/mine', methods=['GET'])
 def mineBlock():
@@ -108,6 +378,17 @@ def mineBlock():
         response = {'message': message}
     return jsonify(response), 200
 
+@app.route('/validator/add', methods=['POST'])
+def addValidator():
+    data = request.get_json()
+    validatorId = data.get('validator_id', None)
+
+    if validatorId is None:
+        return 'Validator ID missing', 400
+
+    blockchain.addValidator(validatorId, float(data.get('opinion_value', 0.5)))
+    return jsonify({'message': f'Validator {validatorId} added'}), 201
+
 @app.route('/transactions/decrypt', methods=['POST'])
 def decryptTransaction():
     data = request.get_json()
@@ -125,16 +406,83 @@ def decryptTransaction():
     if transactionIndex < 1 or transactionIndex > len(block['transactions']):
         return 'Transaction index is invalid', 400
 
-    encryptedMessage = block['transactions'][transactionIndex - 1]['v2xMessage']
-    decryptedMessage = blockchain.decryptMessage(encryptedMessage)
+    decryptedMessage, = blockchain.decryptTransactions(block, [transactionIndex])
     response = {'decryptedMessage': decryptedMessage}
     return jsonify(response), 200
 
+@app.route('/transactions/decrypt/range', methods=['GET'])
+def decryptTransactionRange():
+    # /transactions/decrypt/range?from=&to=&limit=&senderVehicle=&receiverVehicle=, heights as for /chain
+    try:
+        start, end, _ = parseChainQuery(request.args, len(blockchain.wholeChain))
+    except ValueError as e:
+        return str(e), 400
+    transactions = blockchain.iterDecryptedRange(start, end, request.args.get('senderVehicle'), request.args.get('receiverVehicle'))
+    tail = {'from': start, 'to': max(end, start - 1), 'next': end + 1 if end < len(blockchain.wholeChain) else None}
+
+    if end - start + 1 <= decryptRangeInlineBlocks:
+        return jsonify(dict(tail, transactions=list(transactions))), 200
+    return Response(streamJsonList('transactions', transactions, tail), mimetype='application/json'), 200
+
+@app.route('/transactions/decrypt/stats', methods=['GET'])
+def decryptCacheStats():
+    return jsonify(blockchain.decrypted.stats()), 200
+
+@app.route('/transactions/proof', methods=['POST'])
+def transactionProof():
+    data = request.get_json()
+    transactionId = data.get('transactionId', None)
+
+    if transactionId is not None:
+        location = blockchain.findTransaction(transactionId)
+        if location is None:
+            return 'Transaction not found in a sealed block', 404
+        blockIndex, transactionIndex = location
+    else:
+        blockIndex = data.get('blockIndex', None)
+        transactionIndex = data.get('transactionIndex', None)
+        if blockIndex is None or transactionIndex is None:
+            return 'Either transactionId or block index and transaction index are needed', 400
+
+    if blockIndex < 1 or blockIndex > len(blockchain.wholeChain):
+        return 'Block index is invalid', 400
+
+    block = blockchain.wholeChain[blockIndex - 1]
+    if transactionIndex < 1 or transactionIndex > len(block['transactions']):
+        return 'Transaction index is invalid', 400
+
+    return jsonify(blockchain.getInclusionProof(blockIndex, transactionIndex)), 200
+
+@app.route('/transactions/query', methods=['GET'])
+def queryTransactions():
+    # /transactions/query?transactionId=&senderVehicle=&receiverVehicle=&since=&until=&offset=&limit=
+    filters = {field: request.args[field] for field in ['transactionId', 'senderVehicle', 'receiverVehicle'] if field in request.args}
+    try:
+        for field in ['since', 'until']:
+            if field in request.args:
+                filters[field] = float(request.args[field])
+        offset = int(request.args.get('offset', 0))
+        limit = min(int(request.args.get('limit', 100)), 1000)
+    except ValueError:
+        return 'since, until, offset and limit must be numbers', 400
+
+    if not filters:
+        return 'At least one of transactionId, senderVehicle, receiverVehicle, since or until is needed', 400
+    if offset < 0 or limit < 1:
+        return 'offset or limit is invalid', 400
+
+    return jsonify(blockchain.queryTransactions(offset, limit, **filters)), 200
+
 @app.route('/chain', methods=['GET'])
 def whole_chain():
-    return jsonify({'consensusType': 'DPos','chain': blockchain.wholeChain, 'length': len(blockchain.wholeChain)}), 200
+    # /chain?from=&to=&limit=&headers=1, streamed so a full dump does not have to fit in memory
+    try:
+        start, end, headersOnly = parseChainQuery(request.args, len(blockchain.wholeChain))
+    except ValueError as e:
+        return str(e), 400
+    body = streamChain(blockchain.wholeChain, start, end, headersOnly, lengthKey='length', extra={'consensusType': 'DPos'})
+    return Response(body, mimetype='application/json'), 200
 
 if __name__ == '__main__':
-    for i in range(10):
-        blockchain.addValidator(f"vehicle_{i + 1}", reputation_scores[i, 0])
+    addInitialValidators(blockchain)
     app.run(debug=True)
@@ -0,0 +1,129 @@
+import queue
+import threading
+import traceback
+
+# Encryption of new transactions off the request path.
+#
+# A request only checks a transaction, gives it a staging id and queues it. Worker threads take whatever is
+# queued, up to maxBatch entries, encrypt the payloads with one encrypt_many call and hand the entries to
+# onEncrypted in staging id order, so the pool only ever holds encrypted transactions and keeps the order they
+# were acknowledged in. pycryptodome releases the GIL while it encrypts, so workers and requests run side by side.
+#
+# Each entry can carry a key (the server's replay key) that travels with it, to onEncrypted when it is pooled or
+# to onDropped when it never will be. A batch that fails to encrypt is retried one entry at a time so a single bad
+# payload only drops itself, the ids of dropped entries are kept in failedIds for the clients that were told 201.
+
+
+class EncryptionStage:
+    def __init__(self, encryption, onEncrypted, workers=2, maxBatch=256, onDropped=None):
+        self.encryption = encryption
+        self.onEncrypted = onEncrypted  # Called with a list of encrypted entries and their keys, never concurrently
+        self.onDropped = onDropped  # Called with the keys of entries that could not be encrypted
+        self.maxBatch = maxBatch
+        self.queue = queue.Queue()
+        self.condition = threading.Condition()
+        self.lastId = 0  # Last staging id handed out
+        self.pooledThrough = 0  # Every id up to this one has been passed to onEncrypted (or dropped)
+        self.failedIds = set()  # Ids of entries that could not be encrypted and were dropped
+        self.finished = {}  # id -> (encrypted entry, key), entry None if its batch failed, waiting for an earlier id
+        self.workers = [threading.Thread(target=self.work, daemon=True) for _ in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, entries, keys=None):
+        """Queue entries whose 'v2xMessage' is still plaintext, returning their staging ids."""
+        if keys is None:
+            keys = [None] * len(entries)
+        with self.condition:
+            stagedIds = list(range(self.lastId + 1, self.lastId + 1 + len(entries)))
+            self.lastId += len(entries)
+            # Put under the lock so the queue holds the entries in id order
+            for stagedId, entry, key in zip(stagedIds, entries, keys):
+                self.queue.put((stagedId, entry, key))
+        return stagedIds
+
+    def pending(self):
+        with self.condition:
+            return self.lastId - self.pooledThrough
+
+    def status(self, stagedId):
+        """'pending', 'pooled' or 'failed' for an id handed out by submit, None for any other id."""
+        with self.condition:
+            if not 0 < stagedId <= self.lastId:
+                return None
+            if stagedId > self.pooledThrough:
+                return 'pending'
+            return 'failed' if stagedId in self.failedIds else 'pooled'
+
+    def failures(self, limit=100):
+        """Number of dropped entries and the latest limit of their ids."""
+        with self.condition:
+            return len(self.failedIds), sorted(self.failedIds)[-limit:]
+
+    def drain(self, timeout=None):
+        """Wait until every entry submitted so far has been pooled, False on timeout."""
+        with self.condition:
+            lastId = self.lastId
+            return self.condition.wait_for(lambda: self.pooledThrough >= lastId, timeout)
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            batch = [item]
+            while len(batch) < self.maxBatch:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.queue.put(None)  # Leave the stop signal for this worker's next round
+                    break
+                batch.append(item)
+
+            try:
+                encryptedMessages = self.encryption.encrypt_many([entry['v2xMessage'] for _, entry, _ in batch])
+                for (_, entry, _), encryptedV2xMessage in zip(batch, encryptedMessages):
+                    entry['v2xMessage'] = encryptedV2xMessage.decode('utf-8')
+                done = {stagedId: (entry, key) for stagedId, entry, key in batch}
+            except Exception:
+                traceback.print_exc()
+                done = None
+            if done is None:
+                done = {stagedId: (self.encryptOne(entry), key) for stagedId, entry, key in batch}
+
+            with self.condition:
+                self.finished.update(done)
+                ready, readyKeys, dropped = [], [], []
+                while self.pooledThrough + 1 in self.finished:
+                    self.pooledThrough += 1
+                    entry, key = self.finished.pop(self.pooledThrough)
+                    if entry is not None:
+                        ready.append(entry)
+                        readyKeys.append(key)
+                    else:
+                        self.failedIds.add(self.pooledThrough)
+                        dropped.append(key)
+                if ready:
+                    self.onEncrypted(ready, readyKeys)
+                if dropped and self.onDropped is not None:
+                    self.onDropped(dropped)
+                self.condition.notify_all()
+
+    def encryptOne(self, entry):
+        """Entry with its payload encrypted, None if it cannot be."""
+        try:
+            encryptedV2xMessage, = self.encryption.encrypt_many([entry['v2xMessage']])
+        except Exception:
+            # Dropped rather than pooled in plaintext, later ids must not wait on it forever
+            traceback.print_exc()
+            return None
+        entry['v2xMessage'] = encryptedV2xMessage.decode('utf-8')
+        return entry
+
+    def close(self):
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
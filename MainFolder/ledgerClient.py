@@ -0,0 +1,321 @@
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+# Clients for the ledger.
+#
+# The trust scripts talk to a ledger through HttpLedger (the Flask API of dpos.py, possibly on another
+# RSU) or EmbeddedLedger (the Blockchain of dpos.py in this process, no serialisation or sockets).
+# Both offer submitTransaction, submitBatch, addValidators, mine, drain and close; openLedger picks one.
+#
+# LedgerClient keeps a pool of keep-alive connections and runs requests on a thread pool, with at
+# most maxInFlight of them submitted but not answered yet; a caller going over that blocks. Requests
+# sharing an orderKey are sent one after the other in submission order, everything else overlaps.
+#
+# BatchingLedgerClient pools transactions locally and sends them to the ledger as one batch once
+# maxBatchSize of them are waiting or the oldest has waited maxDelay seconds. Senders are spread
+# over numShards batches, each with its own orderKey, so a sender's transactions stay in order
+# while several batches are on the wire.
+
+retryStatusCodes = (502, 503, 504)
+idempotentMethods = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+
+
+def failedBeforeSending(error):
+    """True if a requests error was raised while connecting, so the server never saw the request."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+class LedgerClient:
+    def __init__(self, blockchainUrl, maxInFlight=8, retries=3, backoff=0.1, timeout=30):
+        self.blockchainUrl = blockchainUrl
+        self.retries = retries
+        self.backoff = backoff  # Seconds before the first retry, doubled on every further one
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=maxInFlight)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=maxInFlight)
+        self.slots = threading.BoundedSemaphore(maxInFlight)
+        self.lock = threading.Lock()
+        self.lanes = {}  # orderKey -> calls waiting behind the one being sent
+        self.outstanding = set()
+
+    def get(self, path, orderKey=None):
+        return self.request("GET", path, orderKey=orderKey)
+
+    def post(self, path, json=None, orderKey=None):
+        return self.request("POST", path, json, orderKey)
+
+    def request(self, method, path, json=None, orderKey=None):
+        """Send a request in the background and return a Future of its requests.Response."""
+        self.slots.acquire()
+        future = Future()
+        future.set_running_or_notify_cancel()
+        call = (future, method, path, json, orderKey)
+        with self.lock:
+            self.outstanding.add(future)
+            if orderKey is not None:
+                if orderKey in self.lanes:
+                    self.lanes[orderKey].append(call)
+                    return future
+                self.lanes[orderKey] = deque()
+        self.executor.submit(self.run, call)
+        return future
+
+    def run(self, call):
+        # Keeps sending the calls of the same orderKey on this worker until its lane is empty
+        while call is not None:
+            future, method, path, json, orderKey = call
+            try:
+                future.set_result(self.send(method, path, json))
+            except Exception as e:
+                future.set_exception(e)
+
+            with self.lock:
+                self.outstanding.discard(future)
+                call = None
+                if orderKey is not None:
+                    if self.lanes[orderKey]:
+                        call = self.lanes[orderKey].popleft()
+                    else:
+                        del self.lanes[orderKey]
+            self.slots.release()
+
+    def send(self, method, path, json=None):
+        """Blocking request with retries and exponential backoff.
+
+        Idempotent methods are retried on connection errors, timeouts and 502/503/504. Anything else, such as
+        the transaction POSTs, only when the connection could not be made, a reply lost after the server got
+        the request must not submit its transactions twice.
+        """
+        url = f"{self.blockchainUrl}{path}"
+        idempotent = method in idempotentMethods
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.request(method, url, json=json, timeout=self.timeout)
+                if not idempotent or response.status_code not in retryStatusCodes or attempt == self.retries:
+                    return response
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.retries or not (idempotent or failedBeforeSending(e)):
+                    raise
+            time.sleep(self.backoff * 2 ** attempt)
+
+    def drain(self):
+        """Wait until every request submitted so far has been answered."""
+        with self.lock:
+            outstanding = list(self.outstanding)
+        wait(outstanding)
+
+    def close(self):
+        self.drain()
+        self.executor.shutdown()
+        self.session.close()
+
+
+def resolvedFuture(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def failedFuture(exception):
+    future = Future()
+    future.set_exception(exception)
+    return future
+
+
+def mapFuture(future, function):
+    """Future of function(result of future)."""
+    mapped = Future()
+
+    def done(source):
+        try:
+            mapped.set_result(function(source.result()))
+        except Exception as e:
+            mapped.set_exception(e)
+
+    future.add_done_callback(done)
+    return mapped
+
+
+class HttpLedger:
+    def __init__(self, client):
+        self.client = client
+
+    def submitTransaction(self, senderVehicle, receiverVehicle, v2xMessage):
+        """Future of the server's reply, transactions of one sender are sent in order."""
+        transaction = {'senderVehicle': senderVehicle, 'receiverVehicle': receiverVehicle, 'v2xMessage': v2xMessage}
+        return mapFuture(self.client.post("/transactions/new", transaction, orderKey=senderVehicle), lambda response: response.json())
+
+    def submitBatch(self, transactions, orderKey=None):
+        """Future of {'accepted', 'rejected', 'results'} for a list of transactions."""
+        return mapFuture(self.client.post("/transactions/batch", {'transactions': transactions}, orderKey=orderKey), lambda response: response.json())
+
+    def addValidators(self, opinions):
+        """Add or update every (validatorId, opinionValue), concurrently, and wait for all of them."""
+        pending = [self.client.post("/validator/add", {"validator_id": validatorId, "opinion_value": float(opinionValue)})
+                   for validatorId, opinionValue in opinions]
+        for future in pending:
+            future.result()
+
+    def mine(self):
+        return self.client.get("/mine").result().json()
+
+    def drain(self):
+        self.client.drain()
+
+    def close(self):
+        self.client.close()
+
+
+class EmbeddedLedger:
+    def __init__(self, blockchain, summariseBatch):
+        self.blockchain = blockchain
+        self.summariseBatch = summariseBatch
+        self.lock = threading.Lock()  # The batching timer thread and the trust pipeline share the Blockchain
+
+    def submitTransaction(self, senderVehicle, receiverVehicle, v2xMessage):
+        try:
+            with self.lock:
+                index, stagedId = self.blockchain.newMessage(senderVehicle, receiverVehicle, v2xMessage)
+        except ValueError as e:
+            return failedFuture(e)
+        return resolvedFuture({'message': f'New transaction added to block {index}', 'stagedId': stagedId})
+
+    def submitBatch(self, transactions, orderKey=None):
+        with self.lock:
+            results = self.blockchain.newMessages(transactions)
+        return resolvedFuture(self.summariseBatch(results))
+
+    def addValidators(self, opinions):
+        with self.lock:
+            for validatorId, opinionValue in opinions:
+                self.blockchain.addValidator(validatorId, float(opinionValue))
+
+    def mine(self):
+        with self.lock:
+            newBlock, message = self.blockchain.verifyAndAddBlock()
+        if newBlock:
+            return {'message': message, 'block': newBlock}
+        return {'message': message}
+
+    def drain(self):
+        self.blockchain.staging.drain()
+
+    def close(self):
+        self.drain()
+
+
+def openLedger(mode, blockchainUrl, maxInFlight=8, retries=3):
+    """HttpLedger for mode "http", EmbeddedLedger around the Blockchain of dpos.py for mode "embedded"."""
+    if mode == "embedded":
+        # Imported here so HTTP deployments do not build a Blockchain of their own
+        import dpos
+        dpos.addInitialValidators(dpos.blockchain)
+        return EmbeddedLedger(dpos.blockchain, dpos.summariseBatch)
+    if mode == "http":
+        return HttpLedger(LedgerClient(blockchainUrl, maxInFlight, retries))
+    raise ValueError(f"Unknown ledger mode {mode}")
+
+
+class BatchingLedgerClient:
+    def __init__(self, ledger, maxBatchSize=100, maxDelay=0.05, numShards=4, onFlush=None):
+        self.ledger = ledger
+        self.maxBatchSize = maxBatchSize
+        self.maxDelay = maxDelay
+        self.numShards = numShards
+        self.onFlush = onFlush  # onFlush(transactions, result) after every batch
+        self.pending = [[] for _ in range(numShards)]
+        self.pendingFutures = [[] for _ in range(numShards)]  # One per pending transaction, settled with its batch
+        self.sent = []
+        self.deadline = None
+        self.lock = threading.Lock()
+        self.wakeUp = threading.Condition(self.lock)
+        self.closed = False
+        self.timer = threading.Thread(target=self.flushOnDeadline, daemon=True)
+        self.timer.start()
+
+    def submit(self, senderVehicle, receiverVehicle, v2xMessage):
+        """Queue one transaction, sending its shard's batch when it is full.
+
+        Returns a Future of the ledger's result for this transaction, set once its batch is answered.
+        """
+        shard = zlib.crc32(senderVehicle.encode()) % self.numShards
+        future = Future()
+        with self.lock:
+            self.pending[shard].append({
+                'senderVehicle': senderVehicle,
+                'receiverVehicle': receiverVehicle,
+                'v2xMessage': v2xMessage
+            })
+            self.pendingFutures[shard].append(future)
+            if self.deadline is None:
+                self.deadline = time.monotonic() + self.maxDelay
+                self.wakeUp.notify()
+            if len(self.pending[shard]) >= self.maxBatchSize:
+                self.sendShard(shard)
+        return future
+
+    def flush(self):
+        """Send everything pending and wait until the ledger has taken it, e.g. before a block is forged."""
+        with self.lock:
+            self.sendPending()
+            sent = self.sent
+            self.sent = []
+        for future in sent:
+            future.result()  # Re-raises a batch that failed after its retries
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.closed = True
+            self.wakeUp.notify()
+        self.timer.join()
+
+    def sendShard(self, shard):
+        # Caller holds the lock, so batches of a shard get their orderKey in the order they were cut
+        batch = self.pending[shard]
+        futures = self.pendingFutures[shard]
+        self.pending[shard] = []
+        self.pendingFutures[shard] = []
+        future = self.ledger.submitBatch(batch, orderKey=("batch", shard))
+        future.add_done_callback(lambda done: self.reportBatch(batch, futures, done))
+        # Answered batches are dropped, failed ones are kept for flush to raise
+        self.sent = [sentFuture for sentFuture in self.sent if not sentFuture.done() or sentFuture.exception() is not None]
+        self.sent.append(future)
+
+    def reportBatch(self, batch, futures, future):
+        if future.exception() is not None:
+            for transactionFuture in futures:
+                transactionFuture.set_exception(future.exception())
+            return
+        result = future.result()
+        for transactionFuture, transactionResult in zip(futures, result['results']):
+            transactionFuture.set_result(transactionResult)
+        if self.onFlush is not None:
+            self.onFlush(batch, result)
+
+    def sendPending(self):
+        for shard in range(self.numShards):
+            if self.pending[shard]:
+                self.sendShard(shard)
+        self.deadline = None
+
+    def flushOnDeadline(self):
+        with self.lock:
+            while True:
+                while not self.closed and (self.deadline is None or time.monotonic() < self.deadline):
+                    self.wakeUp.wait(None if self.deadline is None else self.deadline - time.monotonic())
+                if self.closed:
+                    return
+                self.sendPending()
@@ -1,10 +1,12 @@
-import os
 import json
 import numpy as np
-import requests
-import math
-from datetime import datetime
-from RSU_dist_store import update_reputation, reputation_scores
+from time import time
+from bsmCache import parseBsmFilename
+from bsmTimeline import iterBsmsByTime
+from bsmStream import streamBsms, LatencyStats
+from ledgerClient import BatchingLedgerClient, openLedger
+from trustModel import DirectTrustAccumulator, SparseDirectTrustAccumulator, calculateBsmTrustBatch, calculateIndirectTrust, computeIntermediaryOpinionSparse
+from RSU_dist_store import reputation_store, vehicle_registry
 from tempCache.precision import adjustPrecisionErrors
 
 # Folder containing BSM files
@@ -12,11 +14,20 @@ folderName = "BSM_Files"
 blockchain_url = "http://127.0.0.1:5000"
 
 # Parameters
-num_vehicles = 10
 g = 0.15  # History parameter for reputation scores
 transaction_limit = 100  # Forge a block after 100 transactions
 opinion_threshold = 0.5  # Minimum opinion to be eligible as a validator
 b= 0.6
+trust_backend = "dense"  # "sparse" keeps only the observed sender/receiver pairs, for large fleets
+vehicle_timeout = None  # Seconds without a BSM before a vehicle is dropped from the registry, None keeps every vehicle
+stream_mode = False  # Keep watching folderName for new BSM files instead of processing a snapshot
+stream_poll_interval = 0.01  # Seconds between folder polls in stream mode
+stream_queue_size = 256  # Bound of each queue between stream stages, a slow ledger backs up into it
+ledger_mode = "http"  # "embedded" drives the Blockchain of dpos.py in this process instead of going over HTTP
+batch_size = 100  # Transactions sent to the ledger per /transactions/batch request
+batch_max_delay = 0.02  # Seconds a transaction may wait for its batch to fill up
+ledger_max_in_flight = 8  # Ledger requests sent but not answered yet, submitting more waits
+ledger_retries = 3  # Retries of a ledger request on connection errors and 502/503/504, with doubling backoff
 
 # Trust thresholds
 speedAvg = 50  # Average speed
@@ -27,156 +38,135 @@ latitudeRange = (37.77, 37.78)
 longitudeRange = (-122.42, -122.41)
 
 # Initialize trust matrices
-directTrustMatrix = np.zeros((num_vehicles, num_vehicles))
-messageCounts = np.zeros((num_vehicles, num_vehicles))
+directTrustMatrix = np.zeros((len(vehicle_registry), len(vehicle_registry)))
+messageCounts = np.zeros((len(vehicle_registry), len(vehicle_registry)))
+if trust_backend == "sparse":
+    trustAccumulator = vehicle_registry.attach(SparseDirectTrustAccumulator(len(vehicle_registry)))
+else:
+    trustAccumulator = vehicle_registry.attach(DirectTrustAccumulator(len(vehicle_registry)))
 transaction_count = 0
 
 
-def calculateParameterTrust(value, avg, thresholds):
-    deviation = abs(value - avg) / avg
-    for threshold, trustScore in thresholds:
-        if deviation <= threshold:
-            return trustScore
-    return 0  # No trust if beyond max threshold
-
-
-def geometricMean(trustValues):
-    product = np.prod(trustValues)
-    return product ** (1 / len(trustValues)) if trustValues else 0
+def calculateBsmTrust(speed, receivedPower, latitude, longitude):
+    return calculateBsmTrustBatch(speed, receivedPower, latitude, longitude, speedAvg, receivedPowerAvg,
+                                  speedThresholds, powerThresholds, latitudeRange, longitudeRange)
 
 
 def calculateDirectTrust():
     global directTrustMatrix, messageCounts
-    directTrustMatrix = np.zeros((num_vehicles, num_vehicles))
-    messageCounts = np.zeros((num_vehicles, num_vehicles))
+    directTrustMatrix, messageCounts = trustAccumulator.finalise()
+    if trust_backend == "sparse":
+        directTrustMatrix.data[:] = adjustPrecisionErrors(directTrustMatrix.data, b)
+    else:
+        directTrustMatrix[:] = adjustPrecisionErrors(directTrustMatrix, b)
 
-    for filename in os.listdir(folderName):
-        if filename.startswith("bsm") and filename.endswith(".json"):
-            parts = filename.replace("bsm", "").replace(".json", "").split("_")
-            i, j = int(parts[0]), int(parts[1])
 
-            with open(os.path.join(folderName, filename), "r") as f:
-                bsmData = json.load(f)
+def computeComprehensiveEvaluation(directMatrix, indirectMatrix, weight_direct=0.68, weight_indirect=0.32):
+    return weight_direct * directMatrix + weight_indirect * indirectMatrix
 
-            speed = bsmData["speed"]
-            receivedPower = bsmData.get("receivedPower", 0)
-            latitude = bsmData["position"]["latitude"]
-            longitude = bsmData["position"]["longitude"]
 
-            speedTrust = calculateParameterTrust(speed, speedAvg, speedThresholds)
-            powerTrust = calculateParameterTrust(receivedPower, receivedPowerAvg, powerThresholds)
-            latitudeTrust = 0.9 if latitudeRange[0] <= latitude <= latitudeRange[1] else 0.5
-            longitudeTrust = 0.9 if longitudeRange[0] <= longitude <= longitudeRange[1] else 0.5
+def computeIntermediaryOpinion(comprehensiveEvaluation):
+    return np.mean(comprehensiveEvaluation, axis=1)
 
-            bsmTrust = geometricMean([speedTrust, powerTrust, latitudeTrust, longitudeTrust])
+def update_reputation_scores(intermediary_opinion, reputation_store, g):
+    # Current reputation score is the intermediary opinion plus the g, g^2, g^3 weighted history, written for every vehicle as one round
+    reputation_store.update_all(intermediary_opinion + reputation_store.weighted_history(g))
 
-            directTrustMatrix[i - 1, j - 1] += bsmTrust
-            messageCounts[i - 1, j - 1] += 1
+def updateValidators():
+    opinions = reputation_store.latest()
+    validators = []
+    for i in range(len(opinions)):
+        opinion = opinions[i]
+        if opinion >= opinion_threshold:
+            validators.append((f"vehicle_{vehicle_registry.idOf(i)}", opinion))
+    ledger.addValidators(validators)
 
-    # Average the direct trust matrix
-    for i in range(num_vehicles):
-        for j in range(num_vehicles):
-            if messageCounts[i, j] > 0:
-                directTrustMatrix[i, j] /= messageCounts[i, j]
 
-    directTrustMatrix[:] = adjustPrecisionErrors(directTrustMatrix, b)
+def print_batch_result(transactions, result):
+    print(f"Sent {len(transactions)} transactions: {result['accepted']} accepted, {result['rejected']} rejected")
 
 
-def calculateIndirectTrust():
-    numVehicles = directTrustMatrix.shape[0]
-    indirectTrustMatrix = np.zeros((numVehicles, numVehicles))
+ledger = openLedger(ledger_mode, blockchain_url, ledger_max_in_flight, ledger_retries)
+ledger_client = BatchingLedgerClient(ledger, batch_size, batch_max_delay, onFlush=print_batch_result)
 
-    for i in range(numVehicles):
-        for j in range(numVehicles):
-            if i != j:
-                totalTrust = np.sum([directTrustMatrix[k][j] for k in range(numVehicles) if k != i])
-                indirectTrustMatrix[i][j] = totalTrust / (numVehicles - 1)
 
-    return indirectTrustMatrix
+def submit_v2x_message(sender_id, receiver_id, v2xMessage):
+    # Queued, the client sends a /transactions/batch once batch_size are waiting or batch_max_delay has passed.
+    # The returned Future is set with the ledger's result once the batch is answered
+    return ledger_client.submit(f"vehicle_{sender_id}", f"vehicle_{receiver_id}", v2xMessage)
 
 
-def computeComprehensiveEvaluation(directMatrix, indirectMatrix, weight_direct=0.68, weight_indirect=0.32):
-    return weight_direct * directMatrix + weight_indirect * indirectMatrix
+def submit_bsm(sender_id, receiver_id, bsmData):
+    return submit_v2x_message(sender_id, receiver_id, json.dumps(bsmData))
 
 
-def computeIntermediaryOpinion(comprehensiveEvaluation):
-    return np.mean(comprehensiveEvaluation, axis=1)
-
-g= 0.15 #  history parameter
-num_vehicles = 10 
-
-def update_reputation_scores(intermediary_opinion, reputation_scores, g):
-    # Calculate the current reputation score and update the reputation matrix
-    for i in range(num_vehicles):
-        reputationScoreCur = intermediary_opinion[i] + g * reputation_scores[i, 0] + g**2 * reputation_scores[i, 1] + g**3 * reputation_scores[i, 2]
-        update_reputation(i, reputationScoreCur)
-
-def updateValidators():
-    for i in range(num_vehicles):
-        opinion = reputation_scores[i, 0]
-        if opinion >= opinion_threshold:
-            requests.post(f"{blockchain_url}/validator/add", json={"validator_id": f"vehicle_{i + 1}", "opinion_value": opinion})
+def account_bsm(sender_id, receiver_id, bsmTrust, seenAt):
+    global transaction_count
 
+    # Account the BSM as it goes to the ledger, trust rounds only finalise the averages
+    i = vehicle_registry.register(sender_id, seenAt)
+    j = vehicle_registry.register(receiver_id, seenAt)
+    trustAccumulator.add(i, j, bsmTrust)
+    transaction_count += 1
 
-def create_timeQueue():
-    timeQueue = []
-    for filename in os.listdir(folderName):
-        if filename.startswith("bsm") and filename.endswith(".json"):
-            with open(os.path.join(folderName, filename), "r") as f:
-                bsmData = json.load(f)
-                timestamp = datetime.strptime(bsmData["timestamp"], "%Y-%m-%dT%H:%M:%SZ")
-                timeQueue.append((timestamp, filename))
-    # Sort the queue based on timestamp
-    timeQueue.sort(key=lambda x: x[0])
-    return timeQueue
+    # Forge a block and recalculate trust metrics after 100 transactions
+    if transaction_count >= transaction_limit:
+        run_trust_round(seenAt)
 
+        # Reset transaction count
+        transaction_count = 0
 
-def process_bsm_files():
-    global transaction_count
 
-    # Create the timeQueue sorted by timestamp
-    timeQueue = create_timeQueue()
+def run_trust_round(seenAt):
+    # Everything accounted so far has to be in the pool before the block is forged
+    ledger_client.flush()
+    print(ledger.mine())
 
-    for timestamp, filename in timeQueue:
-        parts = filename.replace("bsm", "").replace(".json", "").split("_")
-        sender_vehicle = f"vehicle_{parts[0]}"
-        receiver_vehicle = f"vehicle_{parts[1]}"
+    # Drop vehicles that have gone quiet, then recalculate trust metrics and update reputation scores
+    if vehicle_timeout is not None:
+        vehicle_registry.compact(seenAt - vehicle_timeout)
+    calculateDirectTrust()
+    if trust_backend == "sparse":
+        intermediaryOpinionVector = computeIntermediaryOpinionSparse(directTrustMatrix)
+    else:
+        indirectTrustMatrix = calculateIndirectTrust(directTrustMatrix)
+        comprehensiveEvaluation = computeComprehensiveEvaluation(directTrustMatrix, indirectTrustMatrix)
+        intermediaryOpinionVector = computeIntermediaryOpinion(comprehensiveEvaluation)
+    update_reputation_scores(intermediaryOpinionVector, reputation_store, g)
 
-        with open(os.path.join(folderName, filename), "r") as f:
-            bsmData = json.load(f)
+    print("Updated Reputation Scores:")
+    print(reputation_store.scores)
+    print('-' * 100)
 
-        transaction_data = {
-            "senderVehicle": sender_vehicle,
-            "receiverVehicle": receiver_vehicle,
-            "v2xMessage": json.dumps(bsmData)
-        }
+    # Update validators based on the latest reputation scores
+    updateValidators()
 
-        response = requests.post(f"{blockchain_url}/transactions/new", json=transaction_data)
-        print(f"[{timestamp}] {response.json()}")
-        transaction_count += 1
 
-        # Forge a block and recalculate trust metrics after 100 transactions
-        if transaction_count >= transaction_limit:
-            mine_response = requests.get(f"{blockchain_url}/mine")
-            print(mine_response.json())
+def process_bsm_files():
+    # Every BSM file is parsed once, in timestamp order
+    for timestamp, filename, bsmTrust, v2xMessage in iterBsmsByTime(folderName, calculateBsmTrust):
+        sender_id, receiver_id = parseBsmFilename(filename)
 
-            # Recalculate trust metrics and update reputation scores
-            calculateDirectTrust()
-            indirectTrustMatrix = calculateIndirectTrust()
-            comprehensiveEvaluation = computeComprehensiveEvaluation(directTrustMatrix, indirectTrustMatrix)
-            intermediaryOpinionVector = computeIntermediaryOpinion(comprehensiveEvaluation)
-            update_reputation_scores(intermediaryOpinionVector, reputation_scores, g)
+        submit_v2x_message(sender_id, receiver_id, v2xMessage)
+        account_bsm(sender_id, receiver_id, bsmTrust, float(timestamp.astype(np.int64)))
 
-            print("Updated Reputation Scores:")
-            print(reputation_scores)
-            print('-' * 100)
+    ledger_client.close()
+    ledger.close()
 
-            # Update validators based on the latest reputation scores
-            updateValidators()
 
-            # Reset transaction count
-            transaction_count = 0
+def stream_bsm_files():
+    # Keep ingesting BSM files as the RSU writes them, until interrupted
+    latencyStats = LatencyStats()
+    bsmStream = streamBsms(folderName, calculateBsmTrust, submit_bsm, latencyStats=latencyStats,
+                           pollInterval=stream_poll_interval, queueSize=stream_queue_size)
+    for sender_id, receiver_id, bsmData, bsmTrust in bsmStream:
+        account_bsm(sender_id, receiver_id, bsmTrust, time())
+        if transaction_count == 0:
+            print("Ingest latency:", latencyStats.summary())
 
 
 # Start the process
-process_bsm_files()
+if stream_mode:
+    stream_bsm_files()
+else:
+    process_bsm_files()
@@ -1,10 +1,9 @@
-import os
-import json
 import numpy as np
-import requests
-import math
-from datetime import datetime
-from RSU_dist_store import update_reputation, reputation_scores
+from bsmCache import parseBsmFilename
+from bsmTimeline import iterBsmsByTime
+from ledgerClient import openLedger
+from trustModel import DirectTrustAccumulator, calculateBsmTrustBatch, calculateIndirectTrust, bayesianComprehensiveOpinion, hmmTransitionMatrix, hmmReputationUpdate
+from RSU_dist_store import reputation_store, vehicle_registry
 from tempCache.precision import adjustPrecisionErrors
 
 # Folder containing BSM files
@@ -12,12 +11,15 @@ folderName = "BSM_Files"
 blockchain_url = "http://127.0.0.1:5000"
 
 # Parameters
-num_vehicles = 10
 g = 0.15  # History parameter for reputation scores
 transaction_limit = 100  # Forge a block after 100 transactions
 opinion_threshold = 0.5  # Minimum opinion to be eligible as a validator
 b= 0.6
 l=0.4
+vehicle_timeout = None  # Seconds without a BSM before a vehicle is dropped from the registry, None keeps every vehicle
+ledger_mode = "http"  # "embedded" drives the Blockchain of dpos.py in this process instead of going over HTTP
+ledger_max_in_flight = 8  # Ledger requests sent but not answered yet, submitting more waits
+ledger_retries = 3  # Retries of a ledger request on connection errors and 502/503/504, with doubling backoff
 
 # Trust thresholds
 speedAvg = 50  # Average speed
@@ -28,106 +30,38 @@ latitudeRange = (37.77, 37.78)
 longitudeRange = (-122.42, -122.41)
 
 # Initialize trust matrices
-directTrustMatrix = np.zeros((num_vehicles, num_vehicles))
-messageCounts = np.zeros((num_vehicles, num_vehicles))
+directTrustMatrix = np.zeros((len(vehicle_registry), len(vehicle_registry)))
+messageCounts = np.zeros((len(vehicle_registry), len(vehicle_registry)))
+trustAccumulator = vehicle_registry.attach(DirectTrustAccumulator(len(vehicle_registry)))
 transaction_count = 0
+ledger = openLedger(ledger_mode, blockchain_url, ledger_max_in_flight, ledger_retries)
 
-# Calculate parameter trust using thresholds
-def calculateParameterTrust(value, avg, thresholds):
-    deviation = abs(value - avg) / avg
-    for threshold, trustScore in thresholds:
-        if deviation <= threshold:
-            return trustScore
-    return 0  # No trust if beyond max threshold
-
-# Geometric mean calculation
-def geometricMean(trustValues):
-    product = np.prod(trustValues)
-    return product ** (1 / len(trustValues)) if trustValues else 0
-
-# Bayesian updating for comprehensive opinion
-def bayesianComprehensiveOpinion(prior, likelihood):
-    posterior = (prior * likelihood) / ((prior * likelihood) + ((1 - prior) * (1 - likelihood)))
-    return posterior
-
-# Hidden Markov Model-based Reputation Update
-def hmm_reputation_update(reputation_scores, comprehensive_opinion, gamma=0.15):
-   
-    transition_matrix = np.array([
-        [1 - gamma, gamma],
-        [gamma, 1 - gamma]
-    ])
-    new_reputation = np.zeros((num_vehicles, 1)) 
-    for i in range(num_vehicles):
-        current_reputation = np.array([reputation_scores[i, 0], 1 - reputation_scores[i, 0]])
-        updated_reputation = np.dot(transition_matrix, current_reputation)
-        new_reputation[i,0] = (comprehensive_opinion[i] * updated_reputation[0]) + ((1 - comprehensive_opinion[i]) * updated_reputation[1])
-    print("new reputation", new_reputation)
+# Transition matrix of the reputation HMM, fixed for the configured history parameter
+hmm_transition_matrix = hmmTransitionMatrix(g)
+
+# Hidden Markov Model-based Reputation Update, all vehicles at once
+def hmm_reputation_update(reputation_store, comprehensive_opinion, gamma=0.15, transition_matrix=None):
+    if transition_matrix is None:
+        transition_matrix = hmmTransitionMatrix(gamma)
+    new_reputation = hmmReputationUpdate(reputation_store.latest(), comprehensive_opinion, transition_matrix).reshape(-1, 1)
     new_reputation[:] = adjustPrecisionErrors(new_reputation, l)
-    print("new reputation", new_reputation)
+    reputation_store.update_all(np.clip(new_reputation[:, 0], 0.0, 1.0))
 
-    for i in range(num_vehicles):
-        update_reputation(i, np.clip(new_reputation[i,0], 0.0, 1.0))
-    print("Update reputation", update_reputation)
 
+# Trust of a batch of BSMs
+def calculateBsmTrust(speed, receivedPower, latitude, longitude):
+    return calculateBsmTrustBatch(speed, receivedPower, latitude, longitude, speedAvg, receivedPowerAvg,
+                                  speedThresholds, powerThresholds, latitudeRange, longitudeRange)
 
-# Direct Trust Calculation
+# Direct Trust Calculation over every BSM submitted so far
 def calculateDirectTrust():
     global directTrustMatrix, messageCounts
-    directTrustMatrix = np.zeros((num_vehicles, num_vehicles))
-    messageCounts = np.zeros((num_vehicles, num_vehicles))
-
-    for filename in os.listdir(folderName):
-        if filename.startswith("bsm") and filename.endswith(".json"):
-            parts = filename.replace("bsm", "").replace(".json", "").split("_")
-            i, j = int(parts[0]), int(parts[1])
-
-            with open(os.path.join(folderName, filename), "r") as f:
-                bsmData = json.load(f)
-
-            speed = bsmData["speed"]
-            receivedPower = bsmData.get("receivedPower", 0)
-            latitude = bsmData["position"]["latitude"]
-            longitude = bsmData["position"]["longitude"]
-
-            speedTrust = calculateParameterTrust(speed, speedAvg, speedThresholds)
-            powerTrust = calculateParameterTrust(receivedPower, receivedPowerAvg, powerThresholds)
-            latitudeTrust = 0.9 if latitudeRange[0] <= latitude <= latitudeRange[1] else 0.5
-            longitudeTrust = 0.9 if longitudeRange[0] <= longitude <= longitudeRange[1] else 0.5
-
-            bsmTrust = geometricMean([speedTrust, powerTrust, latitudeTrust, longitudeTrust])
-
-            directTrustMatrix[i - 1, j - 1] += bsmTrust
-            messageCounts[i - 1, j - 1] += 1
-
-    # Average the direct trust matrix
-    for i in range(num_vehicles):
-        for j in range(num_vehicles):
-            if messageCounts[i, j] > 0:
-                directTrustMatrix[i, j] /= messageCounts[i, j]
-
+    directTrustMatrix, messageCounts = trustAccumulator.finalise()
     directTrustMatrix[:] = adjustPrecisionErrors(directTrustMatrix, b)
 
-# Indirect Trust Calculation
-def calculateIndirectTrust():
-    numVehicles = directTrustMatrix.shape[0]
-    indirectTrustMatrix = np.zeros((numVehicles, numVehicles))
-
-    for i in range(numVehicles):
-        for j in range(numVehicles):
-            if i != j:
-                totalTrust = np.sum([directTrustMatrix[k][j] for k in range(numVehicles) if k != i])
-                indirectTrustMatrix[i][j] = totalTrust / (numVehicles - 1)
-
-    return indirectTrustMatrix
-
 # Calculate Comprehensive Opinion
 def computeComprehensiveEvaluation(directMatrix, indirectMatrix):
-    comprehensive_opinion = np.zeros((num_vehicles, num_vehicles))
-    for i in range(num_vehicles):
-        for j in range(num_vehicles):
-            comprehensive_opinion[i, j] = bayesianComprehensiveOpinion(directMatrix[i, j], indirectMatrix[i, j])
-    return comprehensive_opinion
+    return bayesianComprehensiveOpinion(directMatrix, indirectMatrix)
 
 # Calculate intermediary opinions
 def computeIntermediaryOpinion(comprehensiveEvaluation):
@@ -135,60 +69,59 @@ def computeIntermediaryOpinion(comprehensiveEvaluation):
 
 # Update validators based on reputation
 def updateValidators():
-    for i in range(num_vehicles):
-        opinion = reputation_scores[i, 0]
+    opinions = reputation_store.latest()
+    validators = []
+    for i in range(len(opinions)):
+        opinion = opinions[i]
         if opinion >= opinion_threshold:
-            requests.post(f"{blockchain_url}/validator/add", json={"validator_id": f"vehicle_{i + 1}", "opinion_value": opinion})
-
-# Create a time-ordered queue for BSM files
-def create_timeQueue():
-    timeQueue = []
-    for filename in os.listdir(folderName):
-        if filename.startswith("bsm") and filename.endswith(".json"):
-            with open(os.path.join(folderName, filename), "r") as f:
-                bsmData = json.load(f)
-                timestamp = datetime.strptime(bsmData["timestamp"], "%Y-%m-%dT%H:%M:%SZ")
-                timeQueue.append((timestamp, filename))
-    timeQueue.sort(key=lambda x: x[0])
-    return timeQueue
+            validators.append((f"vehicle_{vehicle_registry.idOf(i)}", opinion))
+    ledger.addValidators(validators)
+
+def print_transaction_result(timestamp, future):
+    if future.exception() is None:
+        print(f"[{timestamp}] {future.result()}")
+    else:
+        print(f"[{timestamp}] {future.exception()}")
 
 # Process BSM files and update trust scores
 def process_bsm_files():
     global transaction_count
-    timeQueue = create_timeQueue()
     in_val= l
-    for timestamp, filename in timeQueue:
-        parts = filename.replace("bsm", "").replace(".json", "").split("_")
-        sender_vehicle = f"vehicle_{parts[0]}"
-        receiver_vehicle = f"vehicle_{parts[1]}"
-
-        with open(os.path.join(folderName, filename), "r") as f:
-            bsmData = json.load(f)
-
-        transaction_data = {
-            "senderVehicle": sender_vehicle,
-            "receiverVehicle": receiver_vehicle,
-            "v2xMessage": json.dumps(bsmData)
-        }
-
-        response = requests.post(f"{blockchain_url}/transactions/new", json=transaction_data)
-        print(f"[{timestamp}] {response.json()}")
+    # Every BSM file is parsed once, in timestamp order
+    for timestamp, filename, bsmTrust, v2xMessage in iterBsmsByTime(folderName, calculateBsmTrust):
+        sender_id, receiver_id = parseBsmFilename(filename)
+        sender_vehicle = f"vehicle_{sender_id}"
+        receiver_vehicle = f"vehicle_{receiver_id}"
+        seenAt = float(timestamp.astype(np.int64))
+
+        # Pipelined, only transactions of the same sender wait for each other
+        future = ledger.submitTransaction(sender_vehicle, receiver_vehicle, v2xMessage)
+        future.add_done_callback(lambda done, timestamp=timestamp: print_transaction_result(timestamp, done))
+
+        # Account the BSM as it goes to the ledger, trust rounds only finalise the averages
+        i = vehicle_registry.register(sender_id, seenAt)
+        j = vehicle_registry.register(receiver_id, seenAt)
+        trustAccumulator.add(i, j, bsmTrust)
         transaction_count += 1
 
         if transaction_count >= transaction_limit:
-            mine_response = requests.get(f"{blockchain_url}/mine")
-            print(mine_response.json())
+            ledger.drain()
+            print(ledger.mine())
 
+            if vehicle_timeout is not None:
+                vehicle_registry.compact(seenAt - vehicle_timeout)
             calculateDirectTrust()
-            indirectTrustMatrix = calculateIndirectTrust()
+            indirectTrustMatrix = calculateIndirectTrust(directTrustMatrix)
             comprehensiveEvaluation = computeComprehensiveEvaluation(directTrustMatrix, indirectTrustMatrix)
             intermediaryOpinionVector = computeIntermediaryOpinion(comprehensiveEvaluation)
-            hmm_reputation_update(reputation_scores, intermediaryOpinionVector, g)
+            hmm_reputation_update(reputation_store, intermediaryOpinionVector, g, hmm_transition_matrix)
             print("Updated Reputation Scores:")
-            print(reputation_scores)
+            print(reputation_store.scores)
             print('-' * 100)
             updateValidators()
             transaction_count = 0
 
+    ledger.close()
+
 # Start the process
 process_bsm_files()
@@ -0,0 +1,130 @@
+import random
+
+# Validators and their opinion values, with stake weighted selection.
+#
+# Behaves like the {validatorId: opinionValue} dict the ledgers used before (in, [], +=, -=, values(), items()),
+# but every weight also lives in a Fenwick tree, so a weight update and a selection both cost O(log n) instead
+# of re-summing and walking the dict on every block. A selection draws from the registry's own seeded RNG,
+# so a run can be replayed. snapshot() switches selection to an alias table for O(1) draws while the weights
+# stay put; the first weight update after that goes back to the tree.
+
+
+class ValidatorRegistry:
+    def __init__(self, seed=None, rebuildEvery=100000):
+        self.rng = random.Random(seed)
+        self.slotOf = {}
+        self.validatorIds = []
+        self.weights = []
+        self.tree = [0.0]  # 1-based Fenwick tree over self.weights
+        self.total = 0.0
+        self.rebuildEvery = rebuildEvery  # Float drift of the running sums is cleared after this many updates
+        self.updates = 0
+        self.aliasTable = None
+
+    def __len__(self):
+        return len(self.validatorIds)
+
+    def __contains__(self, validatorId):
+        return validatorId in self.slotOf
+
+    def __iter__(self):
+        return iter(self.validatorIds)
+
+    def __getitem__(self, validatorId):
+        return self.weights[self.slotOf[validatorId]]
+
+    def __setitem__(self, validatorId, opinionValue):
+        slot = self.slotOf.get(validatorId)
+        if slot is None:
+            slot = self.slotOf[validatorId] = len(self.validatorIds)
+            self.validatorIds.append(validatorId)
+            self.weights.append(0.0)
+            self.tree.append(0.0)
+            # The new tree node covers a range that may hold earlier slots
+            node = slot + 1
+            lowest = node - (node & -node)
+            self.tree[node] = sum(max(weight, 0.0) for weight in self.weights[lowest:slot])
+        delta = max(opinionValue, 0.0) - max(self.weights[slot], 0.0)
+        self.weights[slot] = opinionValue
+        self.aliasTable = None
+        self.updates += 1
+        if self.updates >= self.rebuildEvery:
+            self.rebuild()
+            return
+        node = slot + 1
+        while node < len(self.tree):
+            self.tree[node] += delta
+            node += node & -node
+        self.total += delta
+
+    def get(self, validatorId, default=None):
+        slot = self.slotOf.get(validatorId)
+        return default if slot is None else self.weights[slot]
+
+    def keys(self):
+        return list(self.validatorIds)
+
+    def values(self):
+        return list(self.weights)
+
+    def items(self):
+        return list(zip(self.validatorIds, self.weights))
+
+    def totalWeight(self):
+        return self.total
+
+    def rebuild(self):
+        """Recompute the tree from the weights in O(n)."""
+        self.tree = [0.0] + [max(weight, 0.0) for weight in self.weights]
+        for node in range(1, len(self.tree)):
+            parent = node + (node & -node)
+            if parent < len(self.tree):
+                self.tree[parent] += self.tree[node]
+        self.total = sum(max(weight, 0.0) for weight in self.weights)
+        self.updates = 0
+
+    def select(self):
+        """Validator drawn with probability proportional to its weight, None if every weight is zero."""
+        if self.total <= 0:
+            return None
+        if self.aliasTable is not None:
+            return self.selectFromAlias()
+
+        # First slot whose prefix sum exceeds the draw, same rule as walking the dict
+        remaining = self.rng.uniform(0, self.total)
+        node = 0
+        step = 1 << (len(self.tree) - 1).bit_length()
+        while step:
+            nextNode = node + step
+            if nextNode < len(self.tree) and self.tree[nextNode] <= remaining:
+                node = nextNode
+                remaining -= self.tree[nextNode]
+            step >>= 1
+        if node >= len(self.validatorIds):
+            return None
+        return self.validatorIds[node]
+
+    def snapshot(self):
+        """Build a Vose alias table of the current weights, selections are O(1) until a weight changes."""
+        count = len(self.weights)
+        if count == 0 or self.total <= 0:
+            return
+        scaled = [max(weight, 0.0) * count / self.total for weight in self.weights]
+        probability = [1.0] * count
+        alias = list(range(count))
+        small = [slot for slot in range(count) if scaled[slot] < 1.0]
+        large = [slot for slot in range(count) if scaled[slot] >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            probability[less] = scaled[less]
+            alias[less] = more
+            scaled[more] -= 1.0 - scaled[less]
+            (small if scaled[more] < 1.0 else large).append(more)
+        self.aliasTable = (probability, alias)
+
+    def selectFromAlias(self):
+        probability, alias = self.aliasTable
+        slot = self.rng.randrange(len(probability))
+        if self.rng.random() >= probability[slot]:
+            slot = alias[slot]
+        return self.validatorIds[slot]
@@ -0,0 +1,81 @@
+import numpy as np
+
+# Maps arbitrary vehicle ids (the "10" of bsm10_3.json or a BSM vehicleId) to dense row indices.
+# Arrays indexed by those rows (trust matrices, reputation scores) attach themselves to the registry
+# and are told when the fleet grows or when aged out vehicles are compacted away.
+#
+# A listener implements:
+#   setSize(numVehicles, capacity) - the fleet now has numVehicles rows, storage should hold capacity rows
+#   compact(keepRows, capacity)    - rows keepRows move to 0..len(keepRows)-1, everything after is free
+
+
+class VehicleRegistry:
+    def __init__(self, vehicleIds=(), initialCapacity=16):
+        self.rowOf = {}
+        self.vehicleIds = []
+        self.capacity = max(1, initialCapacity)
+        self.lastSeen = np.full(self.capacity, -np.inf)
+        self.listeners = []
+        for vehicleId in vehicleIds:
+            self.register(vehicleId)
+
+    def __len__(self):
+        return len(self.vehicleIds)
+
+    def __contains__(self, vehicleId):
+        return str(vehicleId) in self.rowOf
+
+    def attach(self, listener):
+        self.listeners.append(listener)
+        listener.setSize(len(self), self.capacity)
+        return listener
+
+    def idOf(self, row):
+        return self.vehicleIds[row]
+
+    def register(self, vehicleId, seenAt=None):
+        """Return the row of vehicleId, adding it to the fleet if it is new."""
+        vehicleId = str(vehicleId)
+        row = self.rowOf.get(vehicleId)
+        if row is None:
+            row = len(self.vehicleIds)
+            if row == self.capacity:
+                # Amortised doubling, listeners only reallocate when the capacity changes
+                self.capacity *= 2
+                lastSeen = np.full(self.capacity, -np.inf)
+                lastSeen[:row] = self.lastSeen[:row]
+                self.lastSeen = lastSeen
+            self.rowOf[vehicleId] = row
+            self.vehicleIds.append(vehicleId)
+            for listener in self.listeners:
+                listener.setSize(len(self), self.capacity)
+        if seenAt is not None and seenAt > self.lastSeen[row]:
+            self.lastSeen[row] = seenAt
+        return row
+
+    def registerMany(self, vehicleIds, seenAt=None):
+        """Vectorized register, returns the row of every id in vehicleIds."""
+        uniqueIds, inverse = np.unique(np.asarray(vehicleIds).astype(str), return_inverse=True)
+        uniqueRows = np.array([self.register(vehicleId) for vehicleId in uniqueIds.tolist()], dtype=np.int64)
+        rows = uniqueRows[inverse.reshape(-1)]
+        if seenAt is not None:
+            np.maximum.at(self.lastSeen, rows, seenAt)
+        return rows
+
+    def compact(self, seenBefore):
+        """Drop every vehicle not seen since seenBefore and pack the remaining rows to the front.
+
+        Returns the old rows that were kept, in their new order.
+        """
+        numVehicles = len(self)
+        keepRows = np.flatnonzero(self.lastSeen[:numVehicles] >= seenBefore)
+        if len(keepRows) == numVehicles:
+            return keepRows
+
+        self.vehicleIds = [self.vehicleIds[row] for row in keepRows.tolist()]
+        self.rowOf = {vehicleId: row for row, vehicleId in enumerate(self.vehicleIds)}
+        self.lastSeen[:len(keepRows)] = self.lastSeen[keepRows]
+        self.lastSeen[len(keepRows):] = -np.inf
+        for listener in self.listeners:
+            listener.compact(keepRows, self.capacity)
+        return keepRows
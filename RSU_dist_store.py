@@ -1,16 +1,72 @@
 import numpy as np
+from vehicleRegistry import VehicleRegistry
 
-num_vehicles = 10  # sim 10 vehicles
-reputation_scores = np.full((num_vehicles, 3), 0.5)
+# Vehicles the RSU knows about when it starts, any other vehicle is registered when its first BSM arrives
+initial_vehicle_ids = [str(i + 1) for i in range(10)]
+initial_reputation = 0.5
+history_length = 3  # Rounds of reputation kept per vehicle
 
-def update_reputation(vehicle_id, new_reputation_score):
-    if 0 <= vehicle_id < num_vehicles:
-        # Shifting reputation and then reputation current at 0th index
-        reputation_scores[vehicle_id] = np.roll(reputation_scores[vehicle_id], 1)
-        reputation_scores[vehicle_id, 0] = new_reputation_score
-    else:
-        print(f"Error: vehicle_id {vehicle_id} is out of range.")
+
+class ReputationStore:
+    """Ring buffer of the last historyLength reputation scores of every registered vehicle.
+
+    history[slot, row] holds the scores of one round for the whole fleet. All vehicles share the
+    head slot of the latest round, so a round is written with one contiguous copy and the
+    oldest round is overwritten in place instead of rolling every vehicle's row.
+    """
+
+    def __init__(self, registry, historyLength=history_length, initialReputation=initial_reputation):
+        self.initialReputation = initialReputation
+        self.numVehicles = 0
+        self.head = 0
+        self.history = np.full((historyLength, registry.capacity), initialReputation)
+        registry.attach(self)
+
+    @property
+    def historyLength(self):
+        return self.history.shape[0]
+
+    def setSize(self, numVehicles, capacity):
+        if capacity > self.history.shape[1]:
+            history = np.full((self.historyLength, capacity), self.initialReputation)
+            history[:, :self.history.shape[1]] = self.history
+            self.history = history
+        self.numVehicles = numVehicles
+
+    def compact(self, keepRows, capacity):
+        kept = len(keepRows)
+        self.history[:, :kept] = self.history[:, keepRows]
+        self.history[:, kept:] = self.initialReputation
+        self.numVehicles = kept
+
+    def update_all(self, new_scores_vector):
+        """Start a new round with one score per registered vehicle, overwriting the oldest round."""
+        self.head = (self.head - 1) % self.historyLength
+        np.copyto(self.history[self.head, :self.numVehicles], new_scores_vector)
+
+    def latest(self):
+        """Scores of the latest round, as a view."""
+        return self.history[self.head, :self.numVehicles]
+
+    def last(self, k):
+        """The last k rounds, newest first, as a (k, numVehicles) array."""
+        slots = (self.head + np.arange(k)) % self.historyLength
+        return self.history[slots, :self.numVehicles]
+
+    def weighted_history(self, g, k=None):
+        """g * latest + g^2 * previous + ... + g^k * k-th latest, for every vehicle at once."""
+        k = k or self.historyLength
+        return np.dot(g ** np.arange(1, k + 1), self.last(k))
+
+    @property
+    def scores(self):
+        """(numVehicles, historyLength) copy of the history, latest round in column 0."""
+        return self.last(self.historyLength).T
+
+
+vehicle_registry = VehicleRegistry(initial_vehicle_ids)
+reputation_store = ReputationStore(vehicle_registry)
 
 
 if __name__ == "__main__":
-    print("RSU initialized..")
\ No newline at end of file
+    print("RSU initialized..")
@@ -7,8 +7,11 @@ import json
 # Note - pycryto wasn't working ( buffer errors ) so pycrytodome added
 
 class Encryption:
-    def __init__(self):
-        self.key = os.urandom(16) 
+    def __init__(self, key=None):
+        self.key = key or os.urandom(16)
+        # A persistent ledger passes in its stored key so old transactions stay decryptable
+        self.cipher = AES.new(self.key, AES.MODE_ECB)
+        # ECB keeps no state between calls, so one cipher object serves every message
 
     def pad(self, message):
         padding_needed= (16-len(message) % 16)%16
@@ -16,6 +19,10 @@ class Encryption:
         return message
         # Padding messages so that they are multiple of 16
 
+    def pad_bytes(self, data):
+        return data + b' '*((16-len(data) % 16)%16)
+        # Same space padding as pad, counted in bytes so non ASCII messages stay block aligned
+
 
     # encryption and decryption code 
 
@@ -23,16 +30,42 @@ class Encryption:
     def encrypt(self, message):
         message = self.pad(message)
         #Padding before encrypting
-        cipher = AES.new(self.key, AES.MODE_ECB)
-        encrypted_message = base64.b64encode(cipher.encrypt(message.encode('utf-8')))
+        encrypted_message = base64.b64encode(self.cipher.encrypt(message.encode('utf-8')))
         # Following utf-8 as of now
         return encrypted_message
 
     def decrypt(self, encrypted_message):
-        cipher = AES.new(self.key, AES.MODE_ECB)
-        decrypted_message = cipher.decrypt(base64.b64decode(encrypted_message)).decode('utf-8').rstrip()
+        decrypted_message = self.cipher.decrypt(base64.b64decode(encrypted_message)).decode('utf-8').rstrip()
         return decrypted_message
 
+    def encrypt_packed(self, messages):
+        # Every padded message goes into one buffer and the whole buffer is encrypted in a single call.
+        # Returns the ciphertext and offsets, message i is ciphertext[offsets[i]:offsets[i+1]]
+        plaintexts = [self.pad_bytes(message.encode('utf-8')) for message in messages]
+        offsets = [0]
+        for plaintext in plaintexts:
+            offsets.append(offsets[-1] + len(plaintext))
+        return self.cipher.encrypt(b''.join(plaintexts)), offsets
+
+    def encrypt_many(self, messages):
+        # Batch version of encrypt, each item is base64 on its own so it decrypts with decrypt as before
+        ciphertext, offsets = self.encrypt_packed(messages)
+        view = memoryview(ciphertext)
+        return [base64.b64encode(view[offsets[i]:offsets[i+1]]) for i in range(len(messages))]
+
+    def decrypt_packed(self, ciphertext, offsets):
+        # Inverse of encrypt_packed, one decrypt call for the whole buffer
+        plaintext = memoryview(self.cipher.decrypt(ciphertext))
+        return [bytes(plaintext[offsets[i]:offsets[i+1]]).decode('utf-8').rstrip() for i in range(len(offsets) - 1)]
+
+    def decrypt_many(self, encrypted_messages):
+        # Batch version of decrypt for items produced by encrypt or encrypt_many
+        ciphertexts = [base64.b64decode(encrypted_message) for encrypted_message in encrypted_messages]
+        offsets = [0]
+        for ciphertext in ciphertexts:
+            offsets.append(offsets[-1] + len(ciphertext))
+        return self.decrypt_packed(b''.join(ciphertexts), offsets)
+
     
 
 
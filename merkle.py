@@ -0,0 +1,96 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+# Merkle tree over the transactions of a block.
+#
+# Leaves are SHA-256(0x00 + canonical JSON of the transaction), inner nodes SHA-256(0x01 + left + right),
+# so a leaf can never be passed off as an inner node. An odd node at the end of a level is carried up
+# unchanged instead of being paired with itself. The root of an empty block is SHA-256 of nothing.
+#
+# A proof is the list of sibling hashes from the leaf up, each with the side it sits on:
+#   [{'position': 'left' | 'right', 'hash': <hex>}, ...]
+
+leafPrefix = b'\x00'
+nodePrefix = b'\x01'
+
+
+def hashTransaction(transaction):
+    return hashlib.sha256(leafPrefix + json.dumps(transaction, sort_keys=True).encode()).digest()
+
+
+def hashNode(left, right):
+    return hashlib.sha256(nodePrefix + left + right).digest()
+
+
+def buildMerkleTree(transactions):
+    """Return every level of the tree, leaves first and the root level last."""
+    level = [hashTransaction(transaction) for transaction in transactions]
+    levels = [level]
+    while len(level) > 1:
+        nextLevel = [hashNode(level[k], level[k + 1]) for k in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            nextLevel.append(level[-1])
+        levels.append(nextLevel)
+        level = nextLevel
+    return levels
+
+
+def merkleRootOf(levels):
+    if not levels[-1]:
+        return hashlib.sha256(b'').hexdigest()
+    return levels[-1][0].hex()
+
+
+def merkleRoot(transactions):
+    return merkleRootOf(buildMerkleTree(transactions))
+
+
+def merkleProof(levels, index):
+    """Sibling path of leaf index, O(log n) hashes."""
+    proof = []
+    for level in levels[:-1]:
+        sibling = index ^ 1
+        if sibling < len(level):
+            proof.append({'position': 'left' if sibling < index else 'right', 'hash': level[sibling].hex()})
+        index //= 2
+    return proof
+
+
+def verifyMerkleProof(transaction, proof, root):
+    """True if transaction is in the block whose Merkle root is root."""
+    node = hashTransaction(transaction)
+    for step in proof:
+        sibling = bytes.fromhex(step['hash'])
+        if step['position'] == 'left':
+            node = hashNode(sibling, node)
+        else:
+            node = hashNode(node, sibling)
+    return node.hex() == root
+
+
+class MerkleTreeCache:
+    """Trees of the most recently sealed or proven blocks, a tree that was evicted is rebuilt from its block."""
+
+    def __init__(self, maxTrees=64):
+        self.maxTrees = maxTrees
+        self.trees = OrderedDict()  # block index -> tree levels, least recently used first
+        self.lock = threading.Lock()
+
+    def put(self, blockIndex, levels):
+        with self.lock:
+            self.trees[blockIndex] = levels
+            self.trees.move_to_end(blockIndex)
+            while len(self.trees) > self.maxTrees:
+                self.trees.popitem(last=False)
+
+    def treeOf(self, block):
+        with self.lock:
+            levels = self.trees.get(block['index'])
+            if levels is not None:
+                self.trees.move_to_end(block['index'])
+                return levels
+        levels = buildMerkleTree(block['transactions'])
+        self.put(block['index'], levels)
+        return levels
@@ -1,15 +1,20 @@
 from functools import reduce
 import hashlib
-import random
 import requests
 import json
+import threading
 from time import time
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 from layer1Encryption import Encryption
-import os
-import math
+from merkle import MerkleTreeCache, buildMerkleTree, merkleRootOf, merkleProof
+from chainView import parseChainQuery, streamChain
+from dedup import DuplicateFilter, messageKey
+from encryptionStage import EncryptionStage
+from validatorRegistry import ValidatorRegistry
 import numpy as np
-from RSU_dist_store import update_reputation, reputation_scores
+from bsmCache import loadBsmCache
+from trustModel import DirectTrustAccumulator, calculateBsmTrustBatch, calculateIndirectTrust
+from RSU_dist_store import reputation_store, vehicle_registry
 from tempCache.precision import adjustPrecisionErrors
 folderName = "BSM_Files"
 blockchain_url = "http://127.0.0.1:5000"
@@ -21,56 +26,22 @@ powerThresholds = [(0.1, 0.9), (0.3, 0.6), (1.0, 0.1)]  # threshold ratio, trust
 latitudeRange = (37.77, 37.78)  # latitude range
 longitudeRange = (-122.42, -122.41)  # longitude range
 
-def calculateParameterTrust(value, avg, thresholds):
-    deviation = abs(value - avg) / avg
-    for threshold, trustScore in thresholds:
-        if deviation <= threshold:
-            return trustScore
-    return 0  # No trust if beyond max threshold
+bsmCache = loadBsmCache(folderName)
+# Every sender and receiver gets a row in the registry, whatever its id
+senderRows = vehicle_registry.registerMany(bsmCache.sender)
+receiverRows = vehicle_registry.registerMany(bsmCache.receiver)
 
-def geometricMean(trustValues):
-    product = math.prod(trustValues)
-    return product ** (1 / len(trustValues)) if trustValues else 0
-
-directTrustMatrix = np.zeros((10, 10))
-messageCounts = np.zeros((10, 10))
-# We will be needing both because there can be multiple direct trust valuations for vehicle i from vehicle j as it can receive multiple bsm
+trustAccumulator = DirectTrustAccumulator(len(vehicle_registry))
+# We will be needing both sums and counts because there can be multiple direct trust valuations for vehicle i from vehicle j as it can receive multiple bsm
 # So will average out them.
 
-for filename in os.listdir(folderName):
-    if filename.startswith("bsm") and filename.endswith(".json"):
-        parts = filename.replace("bsm", "").replace(".json", "").split("_")
-        i, j = int(parts[0]), int(parts[1])
-        
-        with open(os.path.join(folderName, filename), "r") as f:
-            bsmData = json.load(f)
-        
-        speed = bsmData["speed"]
-        receivedPower = bsmData.get("receivedPower", 0)  # Assuming receivedPower is already part of the BSM data
-        latitude = bsmData["position"]["latitude"]
-        longitude = bsmData["position"]["longitude"]
-        
-        # Calculate trust for speed
-        speedTrust = calculateParameterTrust(speed, speedAvg, speedThresholds)
-        
-        # Calculate trust for received power
-        powerTrust = calculateParameterTrust(receivedPower, receivedPowerAvg, powerThresholds)
-        
-        # Calculate trust for latitude and longitude
-        latitudeTrust = 0.9 if latitudeRange[0] <= latitude <= latitudeRange[1] else 0.5
-        longitudeTrust = 0.9 if longitudeRange[0] <= longitude <= longitudeRange[1] else 0.5
-        
-        # Compute the BSM trust using the geometric mean of the trusts
-        bsmTrust = geometricMean([speedTrust, powerTrust, latitudeTrust, longitudeTrust])
-        
-        directTrustMatrix[i-1, j-1] += bsmTrust 
-        messageCounts[i-1, j-1] += 1
+# Compute the BSM trust of every message at once, the geometric mean of its speed, received power, latitude and longitude trust
+bsmTrust = calculateBsmTrustBatch(bsmCache.speed, bsmCache.receivedPower, bsmCache.position[:, 0], bsmCache.position[:, 1],
+                                  speedAvg, receivedPowerAvg, speedThresholds, powerThresholds, latitudeRange, longitudeRange)
+trustAccumulator.addBatch(senderRows, receiverRows, bsmTrust)
 
 # Average out the direct trust matrix by dividing by the message counts
-for i in range(10):
-    for j in range(10):
-        if messageCounts[i, j] > 0:
-            directTrustMatrix[i, j] /= messageCounts[i, j]
+directTrustMatrix, messageCounts = trustAccumulator.finalise()
 
 directTrustMatrix= adjustPrecisionErrors(directTrustMatrix)
 # Print the final direct trust matrix
@@ -80,18 +51,6 @@ print()
 print('-'*100)
 print()
 
-def calculateIndirectTrust(directTrustMatrix):
-    numVehicles = directTrustMatrix.shape[0]
-    indirectTrustMatrix = np.zeros((numVehicles, numVehicles))
-
-    for i in range(numVehicles):      # For each vehicle i
-        for j in range(numVehicles):  # For each vehicle j
-            if i != j:
-                totalTrust = np.sum([directTrustMatrix[k][j] for k in range(numVehicles) if k != i])
-                indirectTrustMatrix[i][j] = totalTrust / (numVehicles - 1)
-    
-    return indirectTrustMatrix
-
 # Example Usage
 indirectTrustMatrix = calculateIndirectTrust(directTrustMatrix)
 print("Indirect Trust Matrix:")
@@ -124,30 +83,46 @@ print()
 
 
 g= 0.15 #  history parameter
-num_vehicles = 10 
+validatorSeed = None  # Seed of the validator selection RNG, set it to replay a run
 
-def update_reputation_scores(intermediary_opinion, reputation_scores, g):
-    # Calculate the current reputation score and update the reputation matrix
-    for i in range(num_vehicles):
-        reputationScoreCur = intermediary_opinion[i] + g * reputation_scores[i, 0] + g**2 * reputation_scores[i, 1] + g**3 * reputation_scores[i, 2]
-        update_reputation(i, reputationScoreCur)
+def update_reputation_scores(intermediary_opinion, reputation_store, g):
+    # Current reputation score is the intermediary opinion plus the g, g^2, g^3 weighted history, written for every vehicle as one round
+    reputation_store.update_all(intermediary_opinion + reputation_store.weighted_history(g))
 
-update_reputation_scores(intermediaryOpinionVector, reputation_scores, g)
+update_reputation_scores(intermediaryOpinionVector, reputation_store, g)
 
 print("Reputation scores : ")
-print(reputation_scores)
+print(reputation_store.scores)
 
 print()
 print('-'*100)
 print()
 
 
+transactionFields = ['senderVehicle', 'receiverVehicle', 'v2xMessage']
+
+
+def transactionError(transaction):
+    # Why a submitted transaction cannot be staged, None if it can
+    if not isinstance(transaction, dict) or not all(field in transaction for field in transactionFields):
+        return 'Missing fields in transaction'
+    if not all(isinstance(transaction[field], str) for field in transactionFields):
+        return 'senderVehicle, receiverVehicle and v2xMessage must be strings'
+    return None
+
+
 class Blockchain:
-    def __init__(self):
+    def __init__(self, validatorSeed=None, encryptionWorkers=2):
         self.wholeChain = []
         self.currentTransactions = []
+        self.currentKeys = []  # Replay keys of the pooled transactions, sealed with them
+        self.poolLock = threading.Lock()
         self.encryption = Encryption()
-        self.validators = {}
+        # Transactions are acknowledged once staged and join the pool after the workers encrypt them
+        self.staging = EncryptionStage(self.encryption, self.poolEncrypted, encryptionWorkers, onDropped=self.releaseKeys)
+        self.validators = ValidatorRegistry(validatorSeed)  # dict-like, with O(log n) weighted selection
+        self.merkleTrees = MerkleTreeCache()  # Trees of recent blocks for inclusion proofs, older ones are rebuilt
+        self.duplicates = DuplicateFilter()  # (sender, plaintext digest) of the pool and the last 10 minutes of blocks
         self.opinion = 0.5
         self.threshold = 0.5
         self.addBlock(validatorId='genesisValidator', previousHash='0000')
@@ -173,32 +148,32 @@ class Blockchain:
             raise ValueError("Validator not found in network.")
 
     def selectValidator(self):
-        totalOpinion = sum(self.validators.values())
-        if totalOpinion == 0:
+        if self.validators.totalWeight() <= 0:
             raise ValueError("No validators with positive opinion available.")
-        randomChoice = random.uniform(0, totalOpinion)
-        cumulative = 0
-        for validator, opinion in self.validators.items():
-            cumulative += opinion
-            if cumulative > randomChoice:
-                return validator
-        return None
-
-    def isTransactionUnique(self, newTransaction):
-        for transaction in self.currentTransactions:
-            if transaction['senderVehicle'] == newTransaction['senderVehicle'] and transaction['v2xMessage'] == newTransaction['v2xMessage']:
-                return False
-        return True
+        return self.validators.select()
+
+    def isTransactionUnique(self, senderVehicle, v2xMessage):
+        # O(1): a hash set for the pool, a time-windowed Bloom filter for recently sealed blocks
+        return not self.duplicates.isDuplicate(messageKey(senderVehicle, v2xMessage))
 
     def addBlock(self, validatorId, previousHash=None):
+        # The hash is computed once when the block is sealed and stored in it
+        # Only encrypted transactions ever reach the pool, entries still in the encryption stage wait for the next block
+        with self.poolLock:
+            transactions, keys = self.currentTransactions, self.currentKeys
+            self.currentTransactions, self.currentKeys = [], []
         curBlock = {
             'index': len(self.wholeChain) + 1,
             'timestamp': time(),
-            'transactions': self.currentTransactions,
+            'transactions': transactions,
             'validator': validatorId,
-            'previousHash': previousHash or self.getHash(self.wholeChain[-1])
+            'previousHash': previousHash or self.wholeChain[-1]['hash']
         }
-        self.currentTransactions = []
+        merkleTree = buildMerkleTree(transactions)
+        curBlock['transactionsDigest'] = merkleRootOf(merkleTree)
+        curBlock['hash'] = self.getHash(curBlock)
+        self.merkleTrees.put(curBlock['index'], merkleTree)
+        self.duplicates.seal(curBlock['timestamp'], keys)
         self.wholeChain.append(curBlock)
         return curBlock
 
@@ -209,8 +184,10 @@ class Blockchain:
         return stakedOpinion
 
     def verifyBlock(self, validatorId, stakeValue=0.1):
+        # Everything acknowledged before the block is forged goes into it
+        self.staging.drain()
         lastBlock = self.wholeChain[-1]
-        previousHash = self.getHash(lastBlock)
+        previousHash = lastBlock['hash']
         stakedValue = self.proofOfStake(validatorId, stakeValue)
 
         if stakedValue:
@@ -221,32 +198,114 @@ class Blockchain:
             return None
 
     def newMessage(self, senderVehicle, receiverVehicle, v2xMessage):
-        encryptedV2xMessage = self.encryption.encrypt(v2xMessage).decode('utf-8')
+        error = transactionError({'senderVehicle': senderVehicle, 'receiverVehicle': receiverVehicle, 'v2xMessage': v2xMessage})
+        if error is not None:
+            raise ValueError(error)
+        # Replays are rejected before paying for the encryption
+        if not self.isTransactionUnique(senderVehicle, v2xMessage):
+            raise ValueError("Duplicate transaction detected.")
+        key = messageKey(senderVehicle, v2xMessage)
+        self.duplicates.addPooled(key)
+
+        # Encrypted by the staging workers, the request only waits for the staging id
         newMessageTransaction = {
             'senderVehicle': senderVehicle,
             'receiverVehicle': receiverVehicle,
-            'v2xMessage': encryptedV2xMessage
+            'v2xMessage': v2xMessage
         }
-
-        if self.isTransactionUnique(newMessageTransaction):
-            self.currentTransactions.append(newMessageTransaction)
-            return self.wholeChain[-1]['index'] + 1
-        else:
-            raise ValueError("Duplicate transaction detected.")
+        try:
+            stagedId, = self.staging.submit([newMessageTransaction], [key])
+        except Exception:
+            self.releaseKeys([key])
+            raise
+        return self.wholeChain[-1]['index'] + 1, stagedId
+
+    def poolEncrypted(self, transactions, keys):
+        # Called by the encryption stage with encrypted transactions, in the order they were staged
+        with self.poolLock:
+            self.currentTransactions.extend(transactions)
+            self.currentKeys.extend(keys)
+
+    def releaseKeys(self, keys):
+        # Replay keys of transactions that will never be pooled, they may be submitted again
+        for key in keys:
+            self.duplicates.releasePooled(key)
+
+    def newMessages(self, transactions):
+        # Validate and stage a group of transactions for encryption, one result per item
+        blockIndex = self.wholeChain[-1]['index'] + 1
+        results = []
+        newTransactions = []
+        keys = []
+        for transaction in transactions:
+            error = transactionError(transaction)
+            if error is not None:
+                results.append({'status': 400, 'error': error})
+                continue
+            # Pool keys are added one by one so duplicates inside the batch are caught too
+            if not self.isTransactionUnique(transaction['senderVehicle'], transaction['v2xMessage']):
+                results.append({'status': 400, 'error': 'Duplicate transaction detected.'})
+                continue
+            keys.append(messageKey(transaction['senderVehicle'], transaction['v2xMessage']))
+            self.duplicates.addPooled(keys[-1])
+            newTransactions.append({
+                'senderVehicle': transaction['senderVehicle'],
+                'receiverVehicle': transaction['receiverVehicle'],
+                'v2xMessage': transaction['v2xMessage']
+            })
+            results.append({'status': 201, 'block': blockIndex})
+
+        # Staged together so the workers encrypt the accepted messages in as few passes as possible
+        try:
+            stagedIds = iter(self.staging.submit(newTransactions, keys))
+        except Exception:
+            self.releaseKeys(keys)
+            raise
+        for result in results:
+            if result['status'] == 201:
+                result['stagedId'] = next(stagedIds)
+        return results
 
     def decryptMessage(self, encryptedMessage):
         decryptedMessage = self.encryption.decrypt(encryptedMessage.encode('utf-8'))
         return decryptedMessage
 
+    def getTransactionsDigest(self, transactions):
+        # Merkle root of the transactions, in block order
+        return merkleRootOf(buildMerkleTree(transactions))
+
+    def getInclusionProof(self, blockIndex, transactionIndex):
+        block = self.wholeChain[blockIndex - 1]
+        merkleTree = self.merkleTrees.treeOf(block)
+        return {
+            'blockIndex': blockIndex,
+            'transactionIndex': transactionIndex,
+            'transaction': block['transactions'][transactionIndex - 1],
+            'proof': merkleProof(merkleTree, transactionIndex - 1),
+            'merkleRoot': block['transactionsDigest'],
+            'blockHash': block['hash']
+        }
+
     def getHash(self, block):
-        blockString = json.dumps(block, sort_keys=True)
-        encodedBlockString = blockString.encode()
-        hashedCode = hashlib.sha256(encodedBlockString)
+        # Only the header is hashed, the transactions enter through their digest
+        header = [block['index'], block['timestamp'], block['validator'], block['previousHash'], block['transactionsDigest']]
+        encodedHeader = json.dumps(header).encode()
+        hashedCode = hashlib.sha256(encodedHeader)
         return hashedCode.hexdigest()
 
+    def isChainValid(self, checkTransactions=False):
+        previousHash = '0000'
+        for block in self.wholeChain:
+            if block['previousHash'] != previousHash or block['hash'] != self.getHash(block):
+                return False
+            if checkTransactions and block['transactionsDigest'] != self.getTransactionsDigest(block['transactions']):
+                return False
+            previousHash = block['hash']
+        return True
+
 app = Flask(__name__)
 
-blockchain = Blockchain()
+blockchain = Blockchain(validatorSeed)
 
 @app.route('/', methods= ['GET'])
 def start():
@@ -258,18 +317,29 @@ def start():
 @app.route('/transactions/new', methods=['POST'])
 def newTransaction():
     data = request.get_json()
-    fieldsNeeded = ['senderVehicle', 'receiverVehicle', 'v2xMessage']
-    for field in fieldsNeeded:
-        if field not in data:
-            return 'Missing fields in transaction', 400
+    error = transactionError(data)
+    if error is not None:
+        return error, 400
 
     try:
-        indexObtained = blockchain.newMessage(data['senderVehicle'], data['receiverVehicle'], data['v2xMessage'])
-        response = {'message': f'New message transaction for block number {indexObtained}'}
+        indexObtained, stagedId = blockchain.newMessage(data['senderVehicle'], data['receiverVehicle'], data['v2xMessage'])
+        response = {'message': f'New message transaction for block number {indexObtained}', 'stagedId': stagedId}
         return jsonify(response), 201
     except ValueError as e:
         return str(e), 400
 
+@app.route('/transactions/batch', methods=['POST'])
+def newTransactionBatch():
+    data = request.get_json()
+    transactions = data.get('transactions', None) if isinstance(data, dict) else data
+    if not isinstance(transactions, list):
+        return 'Expected a list of transactions', 400
+
+    results = blockchain.newMessages(transactions)
+    accepted = sum(1 for result in results if result['status'] == 201)
+    response = {'accepted': accepted, 'rejected': len(results) - accepted, 'results': results}
+    return jsonify(response), 200
+
 @app.route('/transactions/decrypt', methods=['POST'])
 def decryptTransaction():
     data = request.get_json()
@@ -291,6 +361,42 @@ def decryptTransaction():
     response = {'decryptedMessage': decryptedMessage}
     return jsonify(response), 200
 
+@app.route('/transactions/proof', methods=['POST'])
+def transactionProof():
+    # Transactions of this ledger carry no id, so they are addressed by position only
+    data = request.get_json()
+    blockIndex = data.get('blockIndex', None)
+    transactionIndex = data.get('transactionIndex', None)
+
+    if blockIndex is None or transactionIndex is None:
+        return 'Either block index or transaction index is missing', 400
+
+    if blockIndex < 1 or blockIndex > len(blockchain.wholeChain):
+        return 'Block index is invalid', 400
+
+    block = blockchain.wholeChain[blockIndex - 1]
+    if transactionIndex < 1 or transactionIndex > len(block['transactions']):
+        return 'Transaction index is invalid', 400
+
+    return jsonify(blockchain.getInclusionProof(blockIndex, transactionIndex)), 200
+
+@app.route('/transactions/staged', methods=['GET'])
+def stagedTransactions():
+    # A staged transaction is in the pool once its stagedId is at most pooledThrough and it is not in failed
+    stagedId = request.args.get('stagedId', type=int)
+    if stagedId is not None:
+        status = blockchain.staging.status(stagedId)
+        if status is None:
+            return 'Unknown stagedId', 404
+        return jsonify({'stagedId': stagedId, 'status': status}), 200
+    failedCount, failed = blockchain.staging.failures()
+    return jsonify({
+        'pending': blockchain.staging.pending(),
+        'pooledThrough': blockchain.staging.pooledThrough,
+        'failedCount': failedCount,
+        'failed': failed
+    }), 200
+
 @app.route('/mine', methods=['GET'])
 def mineBlock():
     try:
@@ -343,13 +449,13 @@ def stakeOpinion():
 
 @app.route('/chain', methods= ['GET'])
 def whole_chain():
-    # whole chain and length
-    response= {
-        'chain': blockchain.wholeChain,
-        'chainLength': len(blockchain.wholeChain)
-    } 
+    # whole chain or a height range (from, to, limit), optionally headers only, streamed block by block
+    try:
+        start, end, headersOnly = parseChainQuery(request.args, len(blockchain.wholeChain))
+    except ValueError as e:
+        return str(e), 400
 
-    return jsonify(response), 200
+    return Response(streamChain(blockchain.wholeChain, start, end, headersOnly), mimetype='application/json'), 200
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -1,11 +1,23 @@
 import hashlib
 import json
 from time import time
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 from layer1Encryption import Encryption
+from chainView import parseChainQuery, streamChain
+from powMiner import PowMiner, expectedHashes, isValidDigest, retarget, targetForZeroDigits
+
+miningProcesses= None # worker processes for the proof of work search, None uses every core
+difficulty= 4 # leading zero hex digits of hash(previousProof, proof) the chain starts from
+blockInterval= 2.0 # seconds per block the difficulty is retargeted towards
+retargetEvery= 10 # blocks between two retargets
 
 class Blockchain:
-    def __init__(self):
+    def __init__(self, miningProcesses=None, difficulty=4, blockInterval=2.0, retargetEvery=10):
+        self.miningProcesses= miningProcesses
+        self.initialTarget= targetForZeroDigits(difficulty)
+        self.blockInterval= blockInterval
+        self.retargetEvery= retargetEvery
+        self.miner= None # process pool is only started by the first proof of work
         self.wholeChain= []
         self.currentTransactions= []
         # Have to also later on add genesis block inside init
@@ -14,14 +26,15 @@ class Blockchain:
         self.encryption = Encryption()  # Encryption instance for use in blockchain
         self.opinion = 0.5 # new block in sub-net/group has opinion value 0
 
-    def addBlock(self, proof, previousHash= None):
-        # proof is based on proof of work algorithm
+    def addBlock(self, proof, previousHash= None, target= None):
+        # proof is based on proof of work algorithm, target is the one the proof was mined against
 
         curBlock= {
             'index': len(self.wholeChain)+ 1, # 1 based
             'timestamp': time(), 
             'transactions': self.currentTransactions,
             'proof': proof,
+            'target': format(target or self.nextTarget(), '064x'),
             'previousHash': previousHash or self.getHash(self.wholeChain[-1])
         }
         # all the transactions will be put in this block so reset all 
@@ -49,7 +62,7 @@ class Blockchain:
         return decrypted_message
     
 
-    def getHash(block):
+    def getHash(self, block):
         # SHA-256 hash based
         # Block needs to be stringified and sorted based on keys of json object to ensure uniform hashing
         # encodes converts to binary bits for hashing
@@ -66,29 +79,47 @@ class Blockchain:
 
 # """
 
-    def validateProof(previousProof, curProof):
-        # simple check if hash(curProof, proof) contains leading 4 zeroes or not
+    def validateProof(self, previousProof, curProof, target= None):
+        # simple check if hash(curProof, proof) as a number is below the target (the next block's by default)
         mergeProofs= f'{previousProof}{curProof}'
         mergeProofs= mergeProofs.encode()
-        hashUnderReview= hashlib.sha256(mergeProofs).hexdigest()
-        if(len(hashUnderReview)>=4 and hashUnderReview[0]=='0' and hashUnderReview[1]=='0' and hashUnderReview[2]=='0' and hashUnderReview[3]=='0'):    return True
-        return False
-
-
-    def proofOfWork(self, previousProof):
-        # have to find curProof such that hash(curProof*previousProof) has 4 leading zeroes = famous riddle to solve
+        return isValidDigest(hashlib.sha256(mergeProofs).digest(), target or self.nextTarget())
+
+    def nextTarget(self):
+        # Every retargetEvery blocks the target is scaled by how long those blocks took against blockInterval each,
+        # by at most 4x either way, so block production converges on blockInterval whatever the hardware and load
+        if not self.wholeChain:
+            return self.initialTarget
+        lastBlock= self.wholeChain[-1]
+        target= int(lastBlock['target'], 16)
+        if len(self.wholeChain) % self.retargetEvery != 0:
+            return target
+        firstBlock= self.wholeChain[max(len(self.wholeChain)- self.retargetEvery- 1, 0)]
+        blocks= lastBlock['index']- firstBlock['index']
+        return retarget(target, lastBlock['timestamp']- firstBlock['timestamp'], blocks* self.blockInterval)
+
+    def blockTimes(self, window= 100):
+        # seconds between consecutive blocks over the last window blocks
+        blocks= self.wholeChain[-(window+ 1):]
+        return [current['timestamp']- previous['timestamp'] for previous, current in zip(blocks, blocks[1:])]
+
+    def proofOfWork(self, previousProof, target= None):
+        # have to find curProof such that hash(curProof*previousProof) is below the target = famous riddle to solve
         # This proof of work makes it so computationally expensive to forge a new block so it necessry makes blockchain immutable
-        curProof= 0
-        while True:
-            result= self.validateProof(previousProof, curProof)
-            if(result):  break
-            else: curProof+=1
-        return curProof
+        # The nonce space is split over worker processes, whichever finds a valid proof first wins
+        if self.miner is None:
+            self.miner= PowMiner(self.miningProcesses)
+        return self.miner.mine(previousProof, target or self.nextTarget())
+
+    def miningStats(self):
+        return {'hashes': self.miner.lastHashes if self.miner else 0,
+                'seconds': self.miner.lastSeconds if self.miner else 0.0,
+                'hashesPerSecond': self.miner.hashesPerSecond() if self.miner else 0.0}
     
 
 app= Flask(__name__)
 
-blockchain= Blockchain()
+blockchain= Blockchain(miningProcesses, difficulty, blockInterval, retargetEvery)
 
 @app.route('/transactions/new', methods= ['POST'])
 def newTransaction():
@@ -141,10 +172,11 @@ def mineBlock():
     # Proof of work algorithm will be executed and new block forged to the chain
     lastBlock= blockchain.wholeChain[-1]
     lastBlockProof= lastBlock['proof']
-    curProof= blockchain.proofOfWork(lastBlockProof)
+    target= blockchain.nextTarget()
+    curProof= blockchain.proofOfWork(lastBlockProof, target)
 
     previousHash= blockchain.getHash(lastBlock)
-    curBlock= blockchain.addBlock(curProof, previousHash)
+    curBlock= blockchain.addBlock(curProof, previousHash, target)
 
     response= {
         'message': 'New block mined',
@@ -152,20 +184,55 @@ def mineBlock():
         'proof': curBlock['proof'],
         'previousHash': curBlock['previousHash'],
         'index': curBlock['index'],
-        'timestamp': curBlock['timestamp']
+        'timestamp': curBlock['timestamp'],
+        'target': curBlock['target'],
+        'mining': blockchain.miningStats()
     }
 
     return jsonify(response), 200
 
+@app.route('/difficulty', methods= ['GET'])
+def currentDifficulty():
+    # target the next block is mined against and how long the recent blocks actually took
+    window= request.args.get('window', 100, type=int)
+    if window<1:
+        return 'window must be positive', 400
+
+    target= blockchain.nextTarget()
+    blockTimes= sorted(blockchain.blockTimes(window))
+    distribution= None
+    if blockTimes:
+        distribution= {
+            'count': len(blockTimes),
+            'mean': sum(blockTimes)/ len(blockTimes),
+            'min': blockTimes[0],
+            'p50': blockTimes[len(blockTimes)// 2],
+            'p90': blockTimes[min(int(len(blockTimes)* 0.9), len(blockTimes)- 1)],
+            'p99': blockTimes[min(int(len(blockTimes)* 0.99), len(blockTimes)- 1)],
+            'max': blockTimes[-1]
+        }
+
+    response= {
+        'target': format(target, '064x'),
+        'difficulty': blockchain.initialTarget/ target, # relative to the starting target
+        'expectedHashes': expectedHashes(target),
+        'blockInterval': blockchain.blockInterval,
+        'retargetEvery': blockchain.retargetEvery,
+        'nextRetargetAt': -(-len(blockchain.wholeChain)// blockchain.retargetEvery)* blockchain.retargetEvery+ 1, # block index
+        'hashesPerSecond': blockchain.miningStats()['hashesPerSecond'],
+        'blockTimes': distribution
+    }
+    return jsonify(response), 200
+
 @app.route('/chain', methods= ['GET'])
 def whole_chain():
-    # whole chain and length
-    response= {
-        'chain': blockchain.wholeChain,
-        'chainLength': len(blockchain.wholeChain)
-    } 
+    # whole chain or a height range (from, to, limit), optionally headers only, streamed block by block
+    try:
+        start, end, headersOnly= parseChainQuery(request.args, len(blockchain.wholeChain))
+    except ValueError as e:
+        return str(e), 400
 
-    return jsonify(response), 200
+    return Response(streamChain(blockchain.wholeChain, start, end, headersOnly), mimetype='application/json'), 200
 
 """
 Now an api end point that combines all multi hierarchial level of encryption, adversarially robust network and ledger will be added
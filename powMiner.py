@@ -0,0 +1,140 @@
+import hashlib
+import multiprocessing
+import os
+import time
+from collections import deque
+
+# Proof of work search spread over a process pool.
+#
+# A proof is valid when sha256(f"{previousProof}{proof}"), read as a 256 bit big-endian number, is below the
+# target; a target of 1 << 240 is the old rule of four leading zero hex digits. The nonce space is cut into
+# chunks handed to the workers a few at a time; the first worker to find a proof sets a shared event and every
+# other worker drops its chunk. Within a chunk the hash state of the previousProof prefix is computed once and
+# copied for each nonce, and the digest is checked as raw bytes.
+
+stopEvent = None
+
+
+def initWorker(event):
+    global stopEvent
+    stopEvent = event
+
+
+maxTarget = 1 << 256
+
+
+def targetForZeroDigits(zeroDigits):
+    """Target equivalent to requiring zeroDigits leading zero hex digits."""
+    return 1 << (256 - 4 * zeroDigits)
+
+
+def targetBytes(target):
+    # Big-endian digests of equal length compare as bytes the way they compare as numbers, only for target < maxTarget
+    return target.to_bytes(32, 'big')
+
+
+def isValidDigest(digest, target):
+    """True if the digest, as a big-endian number, is below target."""
+    return int.from_bytes(digest, 'big') < target
+
+
+def expectedHashes(target):
+    return maxTarget / target
+
+
+def retarget(target, actualSeconds, expectedSeconds, maxFactor=4):
+    """Scale target by how long the last blocks took against how long they should have taken."""
+    actualSeconds = min(max(actualSeconds, expectedSeconds / maxFactor), expectedSeconds * maxFactor)
+    return min(max(int(target * actualSeconds / expectedSeconds), 1), maxTarget)
+
+
+def searchChunk(previousProof, start, count, target, stop=None):
+    """Return (proof or None, hashes computed) for nonces start .. start + count - 1."""
+    stop = stop if stop is not None else stopEvent
+    if target >= maxTarget:
+        # Every digest is below it, the first nonce will do
+        if stop is not None:
+            stop.set()
+        return start, 1
+    prefix = hashlib.sha256(str(previousProof).encode())
+    limit = targetBytes(target)
+    for nonce in range(start, start + count):
+        hashed = prefix.copy()
+        hashed.update(str(nonce).encode())
+        if hashed.digest() < limit:
+            if stop is not None:
+                stop.set()
+            return nonce, nonce - start + 1
+        if stop is not None and nonce & 1023 == 0 and stop.is_set():
+            return None, nonce - start + 1
+    return None, count
+
+
+class PowMiner:
+    def __init__(self, processes=None, chunkSize=50000):
+        self.processes = processes or os.cpu_count() or 1
+        self.chunkSize = chunkSize
+        self.pool = None
+        self.stop = None
+        self.lastHashes = 0
+        self.lastSeconds = 0.0
+
+    def hashesPerSecond(self):
+        return self.lastHashes / self.lastSeconds if self.lastSeconds else 0.0
+
+    def startPool(self):
+        context = multiprocessing.get_context()
+        self.stop = context.Event()
+        self.pool = context.Pool(self.processes, initializer=initWorker, initargs=(self.stop,))
+
+    def mine(self, previousProof, target):
+        """Find a proof for previousProof, recording the hash count and time of the search."""
+        started = time.perf_counter()
+        if self.processes == 1:
+            proof, hashes = self.mineInProcess(previousProof, target)
+        else:
+            proof, hashes = self.mineInPool(previousProof, target)
+        self.lastHashes = hashes
+        self.lastSeconds = time.perf_counter() - started
+        return proof
+
+    def mineInProcess(self, previousProof, target):
+        hashes = 0
+        start = 0
+        while True:
+            proof, count = searchChunk(previousProof, start, self.chunkSize, target)
+            hashes += count
+            if proof is not None:
+                return proof, hashes
+            start += self.chunkSize
+
+    def mineInPool(self, previousProof, target):
+        if self.pool is None:
+            self.startPool()
+        self.stop.clear()
+
+        # Two chunks per worker in flight, the next one is handed out as soon as one comes back
+        pending = deque()
+        nextStart = 0
+        for _ in range(2 * self.processes):
+            pending.append(self.pool.apply_async(searchChunk, (previousProof, nextStart, self.chunkSize, target)))
+            nextStart += self.chunkSize
+
+        proof = None
+        hashes = 0
+        while pending:
+            chunkProof, count = pending.popleft().get()
+            hashes += count
+            if chunkProof is not None and proof is None:
+                proof = chunkProof
+                self.stop.set()
+            if proof is None:
+                pending.append(self.pool.apply_async(searchChunk, (previousProof, nextStart, self.chunkSize, target)))
+                nextStart += self.chunkSize
+        return proof, hashes
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
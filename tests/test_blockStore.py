@@ -0,0 +1,125 @@
+import importlib.util
+import os
+
+import pytest
+
+# Reopening, segment rollover and crash recovery of MainFolder/blockStore.py
+
+repoRoot = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def loadModule(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+blockStore = loadModule("blockStore", os.path.join(repoRoot, "MainFolder", "blockStore.py"))
+
+
+def makeBlock(index):
+    return {'index': index, 'timestamp': 1000.0 + index, 'transactions': [{'v2xMessage': 'x' * index}],
+            'previousHash': f'{index - 1:064x}', 'hash': f'{index:064x}'}
+
+
+def fillStore(directory, count, **options):
+    store = blockStore.BlockStore(directory, **options)
+    for index in range(1, count + 1):
+        store.append(makeBlock(index))
+    store.close()
+
+
+def test_blocksSurviveReopen(tmp_path):
+    fillStore(str(tmp_path), 50, segmentSize=1024)
+    assert len([name for name in os.listdir(tmp_path) if name.startswith("segment")]) > 1
+
+    store = blockStore.BlockStore(str(tmp_path), segmentSize=1024)
+    try:
+        assert len(store) == 50
+        assert list(store) == [makeBlock(index) for index in range(1, 51)]
+        assert store[-1] == makeBlock(50)
+        assert store[10:13] == [makeBlock(11), makeBlock(12), makeBlock(13)]
+        with pytest.raises(IndexError):
+            store[50]
+
+        store.append(makeBlock(51))
+        assert len(store) == 51
+        assert store[49] == makeBlock(50)
+        assert store[-1] == makeBlock(51)
+    finally:
+        store.close()
+
+
+def test_partialIndexRecordIsCut(tmp_path):
+    fillStore(str(tmp_path), 10)
+    with open(tmp_path / "index.bin", "ab") as f:
+        f.write(b"\x01" * (blockStore.indexRecord.size // 2))
+
+    store = blockStore.BlockStore(str(tmp_path))
+    try:
+        assert len(store) == 10
+        assert os.path.getsize(tmp_path / "index.bin") == 10 * blockStore.indexRecord.size
+        store.append(makeBlock(11))
+        assert list(store) == [makeBlock(index) for index in range(1, 12)]
+    finally:
+        store.close()
+
+
+def test_unindexedBytesAreCut(tmp_path):
+    fillStore(str(tmp_path), 10)
+    segmentPath = tmp_path / "segment000000.log"
+    size = os.path.getsize(segmentPath)
+    with open(segmentPath, "ab") as f:
+        f.write(b'{"index": 11, "transac')  # Written before the crash, never indexed
+
+    store = blockStore.BlockStore(str(tmp_path))
+    try:
+        assert len(store) == 10
+        assert os.path.getsize(segmentPath) == size
+        store.append(makeBlock(11))
+        assert store[10] == makeBlock(11)
+    finally:
+        store.close()
+
+
+def test_indexRecordsWithoutDataAreDropped(tmp_path):
+    fillStore(str(tmp_path), 10)
+    segmentPath = tmp_path / "segment000000.log"
+    # The data of the last two blocks did not reach the disk, their index records did
+    store = blockStore.BlockStore(str(tmp_path))
+    cut = store.location(8)[1] + 5
+    store.close()
+    with open(segmentPath, "r+b") as f:
+        f.truncate(cut)
+
+    store = blockStore.BlockStore(str(tmp_path))
+    try:
+        assert len(store) == 8
+        assert store[-1] == makeBlock(8)
+        assert os.path.getsize(segmentPath) == store.location(7)[1] + store.location(7)[2]
+    finally:
+        store.close()
+
+
+def test_segmentsAfterTheLastIndexedOneAreRemoved(tmp_path):
+    fillStore(str(tmp_path), 5)
+    with open(tmp_path / "segment000001.log", "wb") as f:
+        f.write(b'{"index": 6}\n')
+
+    store = blockStore.BlockStore(str(tmp_path))
+    try:
+        assert len(store) == 5
+        assert not os.path.exists(tmp_path / "segment000001.log")
+    finally:
+        store.close()
+
+
+def test_secondOpenIsRefused(tmp_path):
+    store = blockStore.BlockStore(str(tmp_path))
+    try:
+        with pytest.raises(RuntimeError):
+            blockStore.BlockStore(str(tmp_path))
+    finally:
+        store.close()
+    blockStore.BlockStore(str(tmp_path)).close()
@@ -0,0 +1,98 @@
+import importlib.util
+import os
+
+import pytest
+
+# Secondary index queries against a plain scan of the chain, for MainFolder/chainIndex.py
+
+repoRoot = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def loadModule(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+chainIndex = loadModule("chainIndex", os.path.join(repoRoot, "MainFolder", "chainIndex.py"))
+
+
+def makeChain(numBlocks):
+    # Blocks 45 s apart, so time buckets hold one or two blocks; every fifth block is empty
+    wholeChain = []
+    for blockIndex in range(1, numBlocks + 1):
+        transactions = []
+        if blockIndex % 5:
+            for k in range(blockIndex % 4 + 1):
+                transactions.append({'transactionId': f'{blockIndex}.{k}',
+                                     'senderVehicle': f'vehicle_{(blockIndex + k) % 3}',
+                                     'receiverVehicle': f'vehicle_{(blockIndex * k) % 4}'})
+        wholeChain.append({'index': blockIndex, 'timestamp': 1000.0 + 45 * blockIndex, 'transactions': transactions})
+    return wholeChain
+
+
+def scan(wholeChain, transactionId=None, senderVehicle=None, receiverVehicle=None, since=None, until=None):
+    positions = []
+    for block in wholeChain:
+        if since is not None and block['timestamp'] < since or until is not None and block['timestamp'] > until:
+            continue
+        for transactionIndex, transaction in enumerate(block['transactions'], start=1):
+            if transactionId is not None and transaction['transactionId'] != transactionId:
+                continue
+            if senderVehicle is not None and transaction['senderVehicle'] != senderVehicle:
+                continue
+            if receiverVehicle is not None and transaction['receiverVehicle'] != receiverVehicle:
+                continue
+            positions.append(chainIndex.packPosition(block['index'], transactionIndex))
+    return positions
+
+
+queries = [
+    {'transactionId': '7.2'},
+    {'transactionId': 'missing'},
+    {'senderVehicle': 'vehicle_1'},
+    {'receiverVehicle': 'vehicle_0'},
+    {'senderVehicle': 'vehicle_2', 'receiverVehicle': 'vehicle_2'},
+    {'since': 1500.0, 'until': 2200.0},
+    {'since': 2000.0},
+    {'until': 1200.0},
+    {'senderVehicle': 'vehicle_0', 'since': 1400.0, 'until': 3000.0},
+    {'transactionId': '7.2', 'senderVehicle': 'vehicle_2'},
+    {'transactionId': '7.2', 'senderVehicle': 'vehicle_0'},
+]
+
+
+@pytest.mark.parametrize("filters", queries)
+def test_queryMatchesScan(filters):
+    wholeChain = makeChain(60)
+    index = chainIndex.ChainIndex()
+    index.catchUp(wholeChain)
+
+    assert index.query(**filters) == scan(wholeChain, **filters)
+
+
+def test_catchUpIndexesOnlyNewBlocks():
+    wholeChain = makeChain(60)
+    index = chainIndex.ChainIndex()
+    index.catchUp(wholeChain[:20])
+    assert len(index) == 20
+    assert index.query(senderVehicle='vehicle_1') == scan(wholeChain[:20], senderVehicle='vehicle_1')
+
+    index.catchUp(wholeChain)
+    assert len(index) == 60
+    assert index.query(senderVehicle='vehicle_1') == scan(wholeChain, senderVehicle='vehicle_1')
+    index.catchUp(wholeChain)
+    assert len(index) == 60
+
+
+def test_positionsRoundTrip():
+    position = chainIndex.packPosition(123456, 789)
+    assert chainIndex.unpackPosition(position) == (123456, 789)
+
+
+def test_emptyIndexAndNoFilters():
+    index = chainIndex.ChainIndex()
+    assert index.query(since=0.0) == []
+    index.catchUp(makeChain(3))
+    assert index.query() == []
@@ -0,0 +1,100 @@
+import importlib.util
+import os
+
+import pytest
+
+# Bloom filters, window rotation and pool keys, for both copies of dedup.py
+
+repoRoot = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def loadModule(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+dedupModules = [
+    loadModule("dedup", os.path.join(repoRoot, "dedup.py")),
+    loadModule("mainFolderDedup", os.path.join(repoRoot, "MainFolder", "dedup.py")),
+]
+
+
+def keyOf(dedup, k):
+    return dedup.messageKey(f'vehicle_{k % 7}', f'message {k}')
+
+
+@pytest.mark.parametrize("dedup", dedupModules)
+def test_bloomFilterHasNoFalseNegativesAndFewFalsePositives(dedup):
+    bloomFilter = dedup.BloomFilter(2000, 1e-3)
+    for k in range(2000):
+        bloomFilter.add(keyOf(dedup, k))
+
+    assert all(keyOf(dedup, k) in bloomFilter for k in range(2000))
+    falsePositives = sum(keyOf(dedup, k) in bloomFilter for k in range(2000, 22000))
+    assert falsePositives < 20000 * 1e-3 * 5
+
+    bloomFilter.clear()
+    assert keyOf(dedup, 0) not in bloomFilter
+
+
+@pytest.mark.parametrize("dedup", dedupModules)
+def test_windowForgetsKeysOnceTheirSliceIsReused(dedup):
+    window = dedup.TimeWindowedBloomFilter(windowSeconds=10, numSlices=5, capacityPerSlice=100)
+    first, second, third = keyOf(dedup, 1), keyOf(dedup, 2), keyOf(dedup, 3)
+
+    window.add(first, at=0.5)
+    assert first in window
+    window.add(second, at=9.5)  # Last slice of the window that started with first
+    assert first in window and second in window
+
+    window.add(third, at=10.5)  # Reuses the slice first was in
+    assert first not in window
+    assert second in window and third in window
+
+
+@pytest.mark.parametrize("dedup", dedupModules)
+def test_windowAgesOutWithoutReuse(dedup):
+    window = dedup.TimeWindowedBloomFilter(windowSeconds=10, numSlices=5, capacityPerSlice=100)
+    window.add(keyOf(dedup, 1), at=0.5)
+    window.add(keyOf(dedup, 2), at=14.5)  # Slice 7, slice 0 is out of the window although its slot is untouched
+
+    assert keyOf(dedup, 1) not in window
+    assert keyOf(dedup, 2) in window
+
+
+@pytest.mark.parametrize("dedup", dedupModules)
+def test_keysOlderThanTheWindowAreIgnored(dedup):
+    window = dedup.TimeWindowedBloomFilter(windowSeconds=10, numSlices=5, capacityPerSlice=100)
+    window.add(keyOf(dedup, 1), at=20.5)
+    window.add(keyOf(dedup, 2), at=0.5)  # Same slot as slice 10, but older
+
+    assert keyOf(dedup, 1) in window
+    assert keyOf(dedup, 2) not in window
+
+
+@pytest.mark.parametrize("dedup", dedupModules)
+def test_duplicateFilterPoolAndSeal(dedup):
+    duplicates = dedup.DuplicateFilter(windowSeconds=10, numSlices=5, capacityPerSlice=100)
+    sealedKey, stagedKey, droppedKey = keyOf(dedup, 1), keyOf(dedup, 2), keyOf(dedup, 3)
+    for key in (sealedKey, stagedKey, droppedKey):
+        assert not duplicates.isDuplicate(key)
+        duplicates.addPooled(key)
+        assert duplicates.isDuplicate(key)
+
+    duplicates.releasePooled(droppedKey)
+    duplicates.seal(at=100.0, keys=[sealedKey])
+
+    assert not duplicates.isDuplicate(droppedKey)
+    assert duplicates.pooled == {stagedKey}
+    assert sealedKey in duplicates.recent
+    assert duplicates.isDuplicate(sealedKey) and duplicates.isDuplicate(stagedKey)
+
+    duplicates.seal(at=101.0)  # Without keys the whole pool is sealed
+    assert duplicates.pooled == set()
+    assert stagedKey in duplicates.recent
+
+    duplicates.addSealed(droppedKey, at=111.0)  # A later slice reuses the one the first seal went into
+    assert not duplicates.isDuplicate(sealedKey)
+    assert duplicates.isDuplicate(droppedKey)
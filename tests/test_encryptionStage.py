@@ -0,0 +1,141 @@
+import importlib.util
+import os
+import random
+import threading
+import time
+
+import pytest
+
+# Pool order, drain and dropped entries of the encryption stage, for both copies of encryptionStage.py
+
+repoRoot = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def loadModule(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+stageModules = [
+    loadModule("encryptionStage", os.path.join(repoRoot, "encryptionStage.py")),
+    loadModule("mainFolderEncryptionStage", os.path.join(repoRoot, "MainFolder", "encryptionStage.py")),
+]
+
+
+class FakeEncryption:
+    # Reverses each payload, takes a random while per batch so workers finish out of order,
+    # and fails any batch holding a payload that starts with "bad"
+    def __init__(self, seed=0):
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def encrypt_many(self, messages):
+        with self.lock:
+            delay = self.rng.uniform(0, 0.003)
+        time.sleep(delay)
+        if any(message.startswith("bad") for message in messages):
+            raise ValueError("cannot encrypt")
+        return [message[::-1].encode('utf-8') for message in messages]
+
+
+class Pool:
+    def __init__(self):
+        self.entries = []
+        self.keys = []
+        self.dropped = []
+        self.calls = 0
+        self.active = 0
+
+    def onEncrypted(self, entries, keys):
+        self.active += 1
+        assert self.active == 1, "onEncrypted called concurrently"
+        self.calls += 1
+        self.entries.extend(entries)
+        self.keys.extend(keys)
+        self.active -= 1
+
+    def onDropped(self, keys):
+        self.dropped.extend(keys)
+
+
+def makeStage(encryptionStage, pool, **options):
+    return encryptionStage.EncryptionStage(FakeEncryption(), pool.onEncrypted, onDropped=pool.onDropped, **options)
+
+
+@pytest.mark.parametrize("encryptionStage", stageModules)
+def test_entriesArePooledEncryptedInStagingOrder(encryptionStage):
+    pool = Pool()
+    stage = makeStage(encryptionStage, pool, workers=4, maxBatch=5)
+    try:
+        stagedIds = []
+        submitted = 0
+        for size in [1, 7, 3, 20, 1, 12, 40, 6]:
+            entries = [{'v2xMessage': f'message {k}'} for k in range(submitted, submitted + size)]
+            stagedIds.extend(stage.submit(entries, keys=[f'key {k}' for k in range(submitted, submitted + size)]))
+            submitted += size
+
+        assert stage.drain(timeout=10)
+        assert stagedIds == list(range(1, submitted + 1))
+        assert stage.pending() == 0 and stage.pooledThrough == submitted
+        assert [entry['v2xMessage'] for entry in pool.entries] == [f'message {k}'[::-1] for k in range(submitted)]
+        assert pool.keys == [f'key {k}' for k in range(submitted)]
+        assert pool.dropped == []
+        assert {stage.status(stagedId) for stagedId in stagedIds} == {'pooled'}
+    finally:
+        stage.close()
+
+
+@pytest.mark.parametrize("encryptionStage", stageModules)
+def test_drainWaitsForEverythingSubmittedBefore(encryptionStage):
+    pool = Pool()
+    stage = makeStage(encryptionStage, pool, workers=2, maxBatch=3)
+    try:
+        stage.submit([{'v2xMessage': f'message {k}'} for k in range(30)])
+        assert stage.drain(timeout=10)
+        assert len(pool.entries) == 30
+    finally:
+        stage.close()
+
+
+@pytest.mark.parametrize("encryptionStage", stageModules)
+def test_failedBatchDropsOnlyTheBadEntry(encryptionStage):
+    pool = Pool()
+    stage = makeStage(encryptionStage, pool, workers=1, maxBatch=64)
+    try:
+        messages = ['message 0', 'message 1', 'bad message', 'message 3']
+        stagedIds = stage.submit([{'v2xMessage': message} for message in messages], keys=messages)
+        assert stage.drain(timeout=10)
+
+        assert [entry['v2xMessage'] for entry in pool.entries] == [message[::-1] for message in messages if message != 'bad message']
+        assert pool.dropped == ['bad message']
+        assert [stage.status(stagedId) for stagedId in stagedIds] == ['pooled', 'pooled', 'failed', 'pooled']
+        assert stage.failures() == (1, [stagedIds[2]])
+        assert stage.status(0) is None and stage.status(stagedIds[-1] + 1) is None
+    finally:
+        stage.close()
+
+
+@pytest.mark.parametrize("encryptionStage", stageModules)
+def test_pendingUntilEncrypted(encryptionStage):
+    release = threading.Event()
+
+    class BlockedEncryption(FakeEncryption):
+        def encrypt_many(self, messages):
+            release.wait(10)
+            return super().encrypt_many(messages)
+
+    pool = Pool()
+    stage = encryptionStage.EncryptionStage(BlockedEncryption(), pool.onEncrypted, workers=1)
+    try:
+        stagedId, = stage.submit([{'v2xMessage': 'message'}])
+        assert stage.status(stagedId) == 'pending'
+        assert not stage.drain(timeout=0.05)
+        release.set()
+        assert stage.drain(timeout=10)
+        assert stage.status(stagedId) == 'pooled'
+        assert pool.keys == [None]
+    finally:
+        release.set()
+        stage.close()
@@ -0,0 +1,170 @@
+import http.server
+import importlib.util
+import json
+import os
+import random
+import socket
+import threading
+import time
+from concurrent.futures import Future
+
+import pytest
+import requests
+
+# Request ordering, retries and batching of MainFolder/ledgerClient.py, against a local HTTP server and a fake ledger
+
+repoRoot = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def loadModule(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+ledgerClient = loadModule("ledgerClient", os.path.join(repoRoot, "MainFolder", "ledgerClient.py"))
+
+
+class RecordingHandler(http.server.BaseHTTPRequestHandler):
+    # Records the body of every POST in arrival order after a random pause, GET answers with the status in its path
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        time.sleep(self.server.rng.uniform(0, 0.004))
+        with self.server.lock:
+            self.server.received.append(body)
+        if self.path == '/unavailable':
+            self.send_response(503)
+            self.end_headers()
+            return
+        self.send_response(201)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps({'status': 201}).encode())
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.received.append(self.path)
+        self.send_response(int(self.path.strip('/')))
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RecordingHandler)
+    server.rng = random.Random(0)
+    server.lock = threading.Lock()
+    server.received = []
+    thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.01}, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_requestsOfAnOrderKeyArriveInSubmissionOrder(server):
+    client = ledgerClient.LedgerClient(f'http://127.0.0.1:{server.server_port}', maxInFlight=6)
+    try:
+        futures = [client.post('/transactions/new', {'sender': k % 3, 'sequence': k}, orderKey=k % 3) for k in range(90)]
+        assert all(future.result().status_code == 201 for future in futures)
+    finally:
+        client.close()
+
+    assert len(server.received) == 90
+    for sender in range(3):
+        sequences = [body['sequence'] for body in server.received if body['sender'] == sender]
+        assert sequences == sorted(sequences)
+
+
+def test_idempotentRequestsAreRetried(server):
+    client = ledgerClient.LedgerClient(f'http://127.0.0.1:{server.server_port}', retries=2, backoff=0.001)
+    try:
+        assert client.get('/503').result().status_code == 503
+    finally:
+        client.close()
+    assert server.received == ['/503'] * 3
+
+
+def test_postsAreNotRetriedOnceSent(server):
+    client = ledgerClient.LedgerClient(f'http://127.0.0.1:{server.server_port}', retries=2, backoff=0.001)
+    try:
+        assert client.post('/unavailable', {'sequence': 0}).result().status_code == 503
+    finally:
+        client.close()
+    assert server.received == [{'sequence': 0}]
+
+
+def test_postsAreRetriedWhenTheConnectionFails():
+    with socket.socket() as unused:
+        unused.bind(('127.0.0.1', 0))
+        port = unused.getsockname()[1]
+    client = ledgerClient.LedgerClient(f'http://127.0.0.1:{port}', retries=2, backoff=0.001)
+    try:
+        with pytest.raises(requests.ConnectionError) as raised:
+            client.post('/transactions/new', {}).result()
+        assert ledgerClient.failedBeforeSending(raised.value)
+    finally:
+        client.close()
+
+
+class FakeLedger:
+    # Answers every batch on a thread of its own, later batches sometimes first
+    def __init__(self):
+        self.batches = []
+        self.lock = threading.Lock()
+        self.rng = random.Random(1)
+
+    def submitBatch(self, transactions, orderKey=None):
+        future = Future()
+        with self.lock:
+            self.batches.append((orderKey, list(transactions)))
+            delay = self.rng.uniform(0, 0.003)
+
+        def answer():
+            time.sleep(delay)
+            future.set_result({'accepted': len(transactions), 'rejected': 0,
+                               'results': [{'status': 201, 'v2xMessage': transaction['v2xMessage']} for transaction in transactions]})
+
+        threading.Thread(target=answer).start()
+        return future
+
+
+def test_batchingKeepsEachSendersOrder():
+    ledger = FakeLedger()
+    flushed = []
+    client = ledgerClient.BatchingLedgerClient(ledger, maxBatchSize=7, maxDelay=0.01, numShards=3,
+                                               onFlush=lambda transactions, result: flushed.extend(transactions))
+    futures = [client.submit(f'vehicle_{k % 5}', 'vehicle_rsu', f'{k % 5}:{k}') for k in range(200)]
+    client.close()
+
+    assert [future.result()['v2xMessage'] for future in futures] == [f'{k % 5}:{k}' for k in range(200)]
+    assert len(flushed) == 200
+    assert all(len(transactions) <= 7 for _, transactions in ledger.batches)
+
+    shardOf = {}
+    sent = {}
+    for orderKey, transactions in ledger.batches:
+        for transaction in transactions:
+            # A sender always goes through the same shard, so its batches share an orderKey
+            assert shardOf.setdefault(transaction['senderVehicle'], orderKey) == orderKey
+            sent.setdefault(transaction['senderVehicle'], []).append(int(transaction['v2xMessage'].split(':')[1]))
+    for sender in range(5):
+        assert sent[f'vehicle_{sender}'] == list(range(sender, 200, 5))
+
+
+def test_flushRaisesAFailedBatch():
+    class FailingLedger:
+        def submitBatch(self, transactions, orderKey=None):
+            future = Future()
+            future.set_exception(requests.ConnectionError("ledger down"))
+            return future
+
+    client = ledgerClient.BatchingLedgerClient(FailingLedger(), maxBatchSize=10, maxDelay=10, numShards=1)
+    future = client.submit('vehicle_1', 'vehicle_2', 'message')
+    with pytest.raises(requests.ConnectionError):
+        client.flush()
+    assert isinstance(future.exception(), requests.ConnectionError)
+    client.close()
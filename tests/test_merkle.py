@@ -0,0 +1,92 @@
+import importlib.util
+import os
+
+import pytest
+
+# Inclusion proofs and the tree cache, for both copies of merkle.py
+
+repoRoot = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def loadModule(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+merkleModules = [
+    loadModule("merkle", os.path.join(repoRoot, "merkle.py")),
+    loadModule("mainFolderMerkle", os.path.join(repoRoot, "MainFolder", "merkle.py")),
+]
+
+
+def makeTransactions(count):
+    return [{'senderVehicle': f'vehicle_{k}', 'receiverVehicle': f'vehicle_{k + 1}', 'v2xMessage': f'message {k}'}
+            for k in range(count)]
+
+
+@pytest.mark.parametrize("merkle", merkleModules)
+@pytest.mark.parametrize("count", [1, 2, 3, 7, 16, 33])
+def test_everyProofVerifies(merkle, count):
+    transactions = makeTransactions(count)
+    levels = merkle.buildMerkleTree(transactions)
+    root = merkle.merkleRootOf(levels)
+
+    assert root == merkle.merkleRoot(transactions)
+    for index, transaction in enumerate(transactions):
+        proof = merkle.merkleProof(levels, index)
+        assert len(proof) <= (count - 1).bit_length()
+        assert merkle.verifyMerkleProof(transaction, proof, root)
+
+
+@pytest.mark.parametrize("merkle", merkleModules)
+def test_tamperedProofsFail(merkle):
+    transactions = makeTransactions(7)
+    levels = merkle.buildMerkleTree(transactions)
+    root = merkle.merkleRootOf(levels)
+    proof = merkle.merkleProof(levels, 4)
+
+    tamperedTransaction = dict(transactions[4], v2xMessage='message 99')
+    assert not merkle.verifyMerkleProof(tamperedTransaction, proof, root)
+    # Proof of another leaf
+    assert not merkle.verifyMerkleProof(transactions[3], proof, root)
+
+    flippedHash = [dict(step) for step in proof]
+    flippedHash[0]['hash'] = ('0' if flippedHash[0]['hash'][0] != '0' else '1') + flippedHash[0]['hash'][1:]
+    assert not merkle.verifyMerkleProof(transactions[4], flippedHash, root)
+
+    swappedSide = [dict(step, position='left' if step['position'] == 'right' else 'right') for step in proof]
+    assert not merkle.verifyMerkleProof(transactions[4], swappedSide, root)
+
+
+@pytest.mark.parametrize("merkle", merkleModules)
+def test_leafCannotPassAsInnerNode(merkle):
+    transactions = makeTransactions(4)
+    levels = merkle.buildMerkleTree(transactions)
+    root = merkle.merkleRootOf(levels)
+    # The pair of inner nodes under the root, offered as if they were a leaf and its sibling
+    forgedProof = [{'position': 'right', 'hash': levels[1][1].hex()}]
+
+    assert not merkle.verifyMerkleProof({'forged': levels[1][0].hex()}, forgedProof, root)
+
+
+@pytest.mark.parametrize("merkle", merkleModules)
+def test_emptyBlockRoot(merkle):
+    assert merkle.merkleRoot([]) == merkle.merkleRootOf(merkle.buildMerkleTree([]))
+
+
+@pytest.mark.parametrize("merkle", merkleModules)
+def test_treeCacheEvictsLeastRecentlyUsed(merkle):
+    blocks = [{'index': index, 'transactions': makeTransactions(index)} for index in range(1, 6)]
+    cache = merkle.MerkleTreeCache(maxTrees=3)
+    for block in blocks[:3]:
+        cache.put(block['index'], merkle.buildMerkleTree(block['transactions']))
+
+    cache.treeOf(blocks[0])  # Block 1 becomes the most recently used
+    cache.put(blocks[3]['index'], merkle.buildMerkleTree(blocks[3]['transactions']))
+
+    assert list(cache.trees) == [3, 1, 4]
+    # An evicted tree is rebuilt from its block
+    assert cache.treeOf(blocks[1]) == merkle.buildMerkleTree(blocks[1]['transactions'])
+    assert list(cache.trees) == [1, 4, 2]
@@ -0,0 +1,62 @@
+import importlib.util
+import os
+
+import numpy as np
+import pytest
+
+# calculateIndirectTrust against the O(n^3) loop it replaced, for both copies of trustModel.py
+
+repoRoot = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def loadTrustModel(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+trustModels = [
+    loadTrustModel("trustModel", os.path.join(repoRoot, "trustModel.py")),
+    loadTrustModel("mainFolderTrustModel", os.path.join(repoRoot, "MainFolder", "trustModel.py")),
+]
+
+# Small edge cases plus one larger fleet of random (but reproducible) size
+fleetSizes = [1, 2, 10, int(np.random.default_rng(2024).integers(30, 120))]
+
+
+def referenceIndirectTrust(directTrustMatrix):
+    # The loop calculateIndirectTrust used before, kept as the reference
+    numVehicles = directTrustMatrix.shape[0]
+    indirectTrustMatrix = np.zeros((numVehicles, numVehicles))
+
+    for i in range(numVehicles):
+        for j in range(numVehicles):
+            if i != j:
+                totalTrust = np.sum([directTrustMatrix[k][j] for k in range(numVehicles) if k != i])
+                indirectTrustMatrix[i][j] = totalTrust / (numVehicles - 1)
+
+    return indirectTrustMatrix
+
+
+@pytest.mark.parametrize("trustModel", trustModels)
+@pytest.mark.parametrize("numVehicles", fleetSizes)
+def test_indirectTrustMatchesLoopFloat64(trustModel, numVehicles):
+    directTrustMatrix = np.random.default_rng(numVehicles).random((numVehicles, numVehicles))
+
+    indirectTrustMatrix = trustModel.calculateIndirectTrust(directTrustMatrix)
+
+    assert indirectTrustMatrix.dtype == np.float64
+    np.testing.assert_allclose(indirectTrustMatrix, referenceIndirectTrust(directTrustMatrix), rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize("trustModel", trustModels)
+@pytest.mark.parametrize("numVehicles", fleetSizes)
+def test_indirectTrustMatchesLoopFloat32Blocked(trustModel, numVehicles):
+    directTrustMatrix = np.random.default_rng(numVehicles).random((numVehicles, numVehicles))
+    out = np.full((numVehicles, numVehicles), np.nan, dtype=np.float32)
+
+    indirectTrustMatrix = trustModel.calculateIndirectTrust(directTrustMatrix, dtype=np.float32, blockRows=3, out=out)
+
+    assert indirectTrustMatrix is out
+    np.testing.assert_allclose(indirectTrustMatrix, referenceIndirectTrust(directTrustMatrix), rtol=0, atol=1e-6)
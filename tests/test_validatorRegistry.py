@@ -0,0 +1,127 @@
+import importlib.util
+import os
+import random
+
+import pytest
+
+# Fenwick tree and alias table selection against the dict walk they replaced, for both copies of validatorRegistry.py
+
+repoRoot = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def loadModule(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+registryModules = [
+    loadModule("validatorRegistry", os.path.join(repoRoot, "validatorRegistry.py")),
+    loadModule("mainFolderValidatorRegistry", os.path.join(repoRoot, "MainFolder", "validatorRegistry.py")),
+]
+
+
+def referenceSelect(rng, validators):
+    # The walk selectValidator did over the {validatorId: opinionValue} dict, kept as the reference
+    totalOpinion = sum(validators.values())
+    randomChoice = rng.uniform(0, totalOpinion)
+    cumulative = 0
+    for validator, opinion in validators.items():
+        cumulative += opinion
+        if cumulative > randomChoice:
+            return validator
+    return None
+
+
+def makeWeights(count, seed):
+    rng = random.Random(seed)
+    # Whole tenths, so the tree's prefix sums and the walk's running sum round alike
+    return {f'validator_{k}': rng.randint(0, 20) / 10 for k in range(count)}
+
+
+@pytest.mark.parametrize("validatorRegistry", registryModules)
+@pytest.mark.parametrize("count", [1, 2, 5, 37])
+def test_drawsMatchTheDictWalk(validatorRegistry, count):
+    weights = makeWeights(count, count)
+    weights['validator_0'] += 0.5  # At least one positive weight
+    registry = validatorRegistry.ValidatorRegistry(seed=count)
+    for validatorId, opinionValue in weights.items():
+        registry[validatorId] = opinionValue
+    referenceRng = random.Random(count)
+
+    for block in range(300):
+        assert registry.select() == referenceSelect(referenceRng, weights)
+        # Same updates the ledger does after a block
+        validatorId = f'validator_{block % count}'
+        weights[validatorId] += 0.1
+        registry[validatorId] += 0.1
+        assert registry.totalWeight() == pytest.approx(sum(weights.values()))
+
+
+@pytest.mark.parametrize("validatorRegistry", registryModules)
+def test_rebuildMatchesIncrementalTree(validatorRegistry):
+    registry = validatorRegistry.ValidatorRegistry(seed=1)
+    rng = random.Random(1)
+    for _ in range(2000):
+        registry[f'validator_{rng.randrange(50)}'] = rng.uniform(-1, 3)
+
+    tree, total = list(registry.tree), registry.totalWeight()
+    registry.rebuild()
+
+    assert registry.tree == pytest.approx(tree)
+    assert registry.totalWeight() == pytest.approx(total)
+    assert registry.totalWeight() == pytest.approx(sum(max(weight, 0.0) for weight in registry.values()))
+
+
+@pytest.mark.parametrize("validatorRegistry", registryModules)
+def test_periodicRebuild(validatorRegistry):
+    registry = validatorRegistry.ValidatorRegistry(seed=1, rebuildEvery=10)
+    for k in range(25):
+        registry[f'validator_{k % 4}'] = k / 10
+
+    assert registry.updates == 5
+    assert registry.totalWeight() == pytest.approx(sum(registry.values()))
+
+
+@pytest.mark.parametrize("validatorRegistry", registryModules)
+@pytest.mark.parametrize("useAlias", [False, True])
+def test_drawFrequenciesFollowTheWeights(validatorRegistry, useAlias):
+    weights = {'a': 1.0, 'b': 2.0, 'c': 0.0, 'd': -1.0, 'e': 5.0}
+    registry = validatorRegistry.ValidatorRegistry(seed=7)
+    for validatorId, opinionValue in weights.items():
+        registry[validatorId] = opinionValue
+    if useAlias:
+        registry.snapshot()
+        assert registry.aliasTable is not None
+
+    draws = 40000
+    counts = dict.fromkeys(weights, 0)
+    for _ in range(draws):
+        counts[registry.select()] += 1
+
+    assert counts['c'] == 0 and counts['d'] == 0
+    for validatorId in ('a', 'b', 'e'):
+        assert counts[validatorId] / draws == pytest.approx(weights[validatorId] / 8.0, abs=0.01)
+
+
+@pytest.mark.parametrize("validatorRegistry", registryModules)
+def test_updateDropsTheAliasTable(validatorRegistry):
+    registry = validatorRegistry.ValidatorRegistry(seed=1)
+    registry['a'] = 1.0
+    registry['b'] = 0.0
+    registry.snapshot()
+    registry['a'] = 0.0
+    registry['b'] = 1.0
+
+    assert registry.aliasTable is None
+    assert {registry.select() for _ in range(50)} == {'b'}
+
+
+@pytest.mark.parametrize("validatorRegistry", registryModules)
+def test_noPositiveWeight(validatorRegistry):
+    registry = validatorRegistry.ValidatorRegistry(seed=1)
+    assert registry.select() is None
+    registry['a'] = 0.0
+    registry['b'] = -2.0
+    assert registry.select() is None
@@ -0,0 +1,253 @@
+import numpy as np
+
+# Shared pieces of the trust model used by the opinion calculation and ledger scripts
+
+
+def calculateParameterTrustBatch(values, avg, thresholds):
+    """Vectorized calculateParameterTrust, the trust score of the first threshold each deviation falls under."""
+    deviation = np.abs(np.asarray(values, dtype=np.float64) - avg) / avg
+    limits = np.array([threshold for threshold, _ in thresholds], dtype=np.float64)
+    trustScores = np.array([trustScore for _, trustScore in thresholds] + [0], dtype=np.float64)
+    # The first threshold >= deviation is also the first one whose running maximum is >= deviation,
+    # and the running maximum is sorted so a binary search finds it. Past every threshold means no trust.
+    return trustScores[np.searchsorted(np.maximum.accumulate(limits), deviation, side='left')]
+
+
+def calculateRangeTrustBatch(values, valueRange, inside=0.9, outside=0.5):
+    values = np.asarray(values, dtype=np.float64)
+    return np.where((valueRange[0] <= values) & (values <= valueRange[1]), inside, outside)
+
+
+def geometricMeanBatch(trustColumns):
+    """Row-wise geometric mean of equally long trust arrays, computed in log space."""
+    with np.errstate(divide='ignore'):
+        logSum = sum(np.log(column) for column in trustColumns)
+    return np.exp(logSum / len(trustColumns))
+
+
+def calculateBsmTrustBatch(speed, receivedPower, latitude, longitude, speedAvg, receivedPowerAvg,
+                           speedThresholds, powerThresholds, latitudeRange, longitudeRange):
+    """Return the bsmTrust of every message given as arrays of speed, receivedPower, latitude and longitude."""
+    return geometricMeanBatch([
+        calculateParameterTrustBatch(speed, speedAvg, speedThresholds),
+        calculateParameterTrustBatch(receivedPower, receivedPowerAvg, powerThresholds),
+        calculateRangeTrustBatch(latitude, latitudeRange),
+        calculateRangeTrustBatch(longitude, longitudeRange),
+    ])
+
+
+def calculateIndirectTrust(directTrustMatrix, dtype=None, blockRows=None, out=None):
+    """Indirect trust of i in j, the mean of what every other vehicle k != i thinks of j.
+
+    That is the column sum of j minus row i's own entry, divided by n - 1, so only the
+    column sums are needed. dtype (e.g. np.float32) and blockRows bound the memory of
+    large fleets, and out may be a preallocated array or np.memmap to write into.
+    """
+    numVehicles = directTrustMatrix.shape[0]
+    dtype = np.dtype(dtype or directTrustMatrix.dtype)
+    indirectTrustMatrix = out if out is not None else np.empty((numVehicles, numVehicles), dtype=dtype)
+    if numVehicles < 2:
+        indirectTrustMatrix[:] = 0
+        return indirectTrustMatrix
+
+    columnSums = np.sum(directTrustMatrix, axis=0, dtype=np.float64)
+    blockRows = blockRows or numVehicles
+    for start in range(0, numVehicles, blockRows):
+        stop = min(start + blockRows, numVehicles)
+        block = indirectTrustMatrix[start:stop]
+        np.subtract(columnSums, directTrustMatrix[start:stop], out=block, casting='unsafe')
+        block /= numVehicles - 1
+        # A vehicle has no indirect trust in itself
+        block[np.arange(stop - start), np.arange(start, stop)] = 0
+
+    return indirectTrustMatrix
+
+
+def bayesianComprehensiveOpinion(prior, likelihood, undefined=0.5):
+    """Bayesian update of the direct trust prior with the indirect trust likelihood, element-wise.
+
+    When prior and likelihood sit at opposite extremes (0 and 1) the posterior is 0/0,
+    those cells get the undefined value instead of nan.
+    """
+    prior = np.asarray(prior, dtype=np.float64)
+    likelihood = np.asarray(likelihood, dtype=np.float64)
+    numerator = prior * likelihood
+    denominator = numerator + (1 - prior) * (1 - likelihood)
+    posterior = np.full(np.broadcast(numerator, denominator).shape, undefined, dtype=np.float64)
+    np.divide(numerator, denominator, out=posterior, where=denominator != 0)
+    return posterior
+
+
+def hmmTransitionMatrix(gamma):
+    """Two state (trusted, untrusted) transition matrix, gamma is the chance of switching state."""
+    return np.array([
+        [1 - gamma, gamma],
+        [gamma, 1 - gamma]
+    ])
+
+
+def hmmReputationUpdate(currentReputation, comprehensiveOpinion, transitionMatrix):
+    """One HMM step for every vehicle, the predicted trusted/untrusted state weighted by the new opinion."""
+    currentReputation = np.asarray(currentReputation, dtype=np.float64)
+    comprehensiveOpinion = np.asarray(comprehensiveOpinion, dtype=np.float64)
+    predicted = transitionMatrix @ np.stack([currentReputation, 1 - currentReputation])
+    return comprehensiveOpinion * predicted[0] + (1 - comprehensiveOpinion) * predicted[1]
+
+
+class DirectTrustAccumulator:
+    """Running direct trust sums and message counts per (i, j), fed one BSM at a time.
+
+    Scores are added as the BSMs are submitted to the ledger, so a trust round only
+    has to turn the sums into averages instead of re-scoring the whole folder.
+    Attached to a VehicleRegistry, the matrices grow and compact with the fleet.
+    """
+
+    def __init__(self, numVehicles):
+        self.numVehicles = numVehicles
+        self.trustSums = np.zeros((numVehicles, numVehicles))
+        self.messageCounts = np.zeros((numVehicles, numVehicles))
+
+    def setSize(self, numVehicles, capacity):
+        if capacity > self.trustSums.shape[0]:
+            previous = self.trustSums.shape[0]
+            trustSums = np.zeros((capacity, capacity))
+            messageCounts = np.zeros((capacity, capacity))
+            trustSums[:previous, :previous] = self.trustSums
+            messageCounts[:previous, :previous] = self.messageCounts
+            self.trustSums, self.messageCounts = trustSums, messageCounts
+        self.numVehicles = numVehicles
+
+    def compact(self, keepRows, capacity):
+        kept = len(keepRows)
+        for matrix in (self.trustSums, self.messageCounts):
+            matrix[:kept, :kept] = matrix[np.ix_(keepRows, keepRows)]
+            matrix[kept:, :] = 0
+            matrix[:, kept:] = 0
+        self.numVehicles = kept
+
+    def add(self, i, j, bsmTrust):
+        """Record the trust score of one BSM sent by vehicle row i to vehicle row j."""
+        self.trustSums[i, j] += bsmTrust
+        self.messageCounts[i, j] += 1
+
+    def addBatch(self, i, j, bsmTrust):
+        """Scatter-add the trust scores of many BSMs given as arrays of rows i, j in one pass."""
+        capacity = self.trustSums.shape[0]
+        cells = np.asarray(i, dtype=np.int64) * capacity + np.asarray(j, dtype=np.int64)
+        self.trustSums += np.bincount(cells, weights=bsmTrust, minlength=capacity * capacity).reshape(capacity, capacity)
+        self.messageCounts += np.bincount(cells, minlength=capacity * capacity).reshape(capacity, capacity)
+
+    def finalise(self):
+        """Return (directTrustMatrix, messageCounts) averaged over every BSM added so far."""
+        trustSums = self.trustSums[:self.numVehicles, :self.numVehicles]
+        messageCounts = self.messageCounts[:self.numVehicles, :self.numVehicles]
+        directTrustMatrix = np.zeros_like(trustSums)
+        np.divide(trustSums, messageCounts, out=directTrustMatrix, where=messageCounts > 0)
+        return directTrustMatrix, messageCounts.copy()
+
+    def reset(self):
+        self.trustSums[:] = 0
+        self.messageCounts[:] = 0
+
+
+class SparseTrustMatrix:
+    """Coordinate form of an n x n trust matrix that only holds the observed (i, j) pairs."""
+
+    def __init__(self, rows, cols, data, numVehicles):
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.cols = np.asarray(cols, dtype=np.int64)
+        self.data = np.asarray(data, dtype=np.float64)
+        self.numVehicles = numVehicles
+
+    @property
+    def shape(self):
+        return (self.numVehicles, self.numVehicles)
+
+    @property
+    def nnz(self):
+        return len(self.data)
+
+    def rowSums(self):
+        return np.bincount(self.rows, weights=self.data, minlength=self.numVehicles)
+
+    def columnSums(self):
+        return np.bincount(self.cols, weights=self.data, minlength=self.numVehicles)
+
+    def diagonal(self):
+        diagonal = np.zeros(self.numVehicles)
+        onDiagonal = self.rows == self.cols
+        diagonal[self.rows[onDiagonal]] = self.data[onDiagonal]
+        return diagonal
+
+    def toDense(self):
+        denseMatrix = np.zeros(self.shape)
+        denseMatrix[self.rows, self.cols] = self.data
+        return denseMatrix
+
+
+class SparseDirectTrustAccumulator:
+    """Dict-of-keys version of DirectTrustAccumulator for fleets where a vehicle only hears its neighbours.
+
+    Memory and finalise time scale with the number of observed sender/receiver pairs instead of n^2.
+    """
+
+    def __init__(self, numVehicles):
+        self.numVehicles = numVehicles
+        self.trustSums = {}
+        self.messageCounts = {}
+
+    def setSize(self, numVehicles, capacity):
+        self.numVehicles = numVehicles
+
+    def compact(self, keepRows, capacity):
+        newRow = {row: index for index, row in enumerate(keepRows.tolist())}
+        self.trustSums = {(newRow[i], newRow[j]): trustSum for (i, j), trustSum in self.trustSums.items()
+                          if i in newRow and j in newRow}
+        self.messageCounts = {(newRow[i], newRow[j]): count for (i, j), count in self.messageCounts.items()
+                              if i in newRow and j in newRow}
+        self.numVehicles = len(keepRows)
+
+    def add(self, i, j, bsmTrust):
+        self.trustSums[(i, j)] = self.trustSums.get((i, j), 0.0) + bsmTrust
+        self.messageCounts[(i, j)] = self.messageCounts.get((i, j), 0) + 1
+
+    def addBatch(self, i, j, bsmTrust):
+        rows = np.asarray(i, dtype=np.int64)
+        cols = np.asarray(j, dtype=np.int64)
+        pairs, inverse = np.unique(np.stack([rows, cols], axis=1), axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        sums = np.bincount(inverse, weights=bsmTrust, minlength=len(pairs))
+        counts = np.bincount(inverse, minlength=len(pairs))
+        for (row, col), trustSum, count in zip(pairs.tolist(), sums.tolist(), counts.tolist()):
+            self.trustSums[(row, col)] = self.trustSums.get((row, col), 0.0) + trustSum
+            self.messageCounts[(row, col)] = self.messageCounts.get((row, col), 0) + count
+
+    def finalise(self):
+        """Return (directTrustMatrix, messageCounts) as SparseTrustMatrix over the observed pairs."""
+        pairs = list(self.trustSums)
+        rows = [i for i, _ in pairs]
+        cols = [j for _, j in pairs]
+        sums = np.fromiter(self.trustSums.values(), dtype=np.float64, count=len(pairs))
+        counts = np.fromiter(self.messageCounts.values(), dtype=np.float64, count=len(pairs))
+        return (SparseTrustMatrix(rows, cols, sums / counts, self.numVehicles),
+                SparseTrustMatrix(rows, cols, counts, self.numVehicles))
+
+    def reset(self):
+        self.trustSums.clear()
+        self.messageCounts.clear()
+
+
+def computeIntermediaryOpinionSparse(directTrustMatrix, weight_direct=0.68, weight_indirect=0.32):
+    """Row means of the linear comprehensive evaluation, straight from a sparse direct trust matrix.
+
+    Row i of the indirect matrix sums to (total - columnSums[i] - (rowSums[i] - direct[i, i])) / (n - 1),
+    so neither the indirect nor the comprehensive matrix has to be built.
+    """
+    numVehicles = directTrustMatrix.numVehicles
+    rowSums = directTrustMatrix.rowSums()
+    columnSums = directTrustMatrix.columnSums()
+    if numVehicles < 2:
+        indirectRowSums = np.zeros(numVehicles)
+    else:
+        indirectRowSums = (columnSums.sum() - columnSums - (rowSums - directTrustMatrix.diagonal())) / (numVehicles - 1)
+    return (weight_direct * rowSums + weight_indirect * indirectRowSums) / numVehicles